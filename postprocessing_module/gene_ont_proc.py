@@ -1,62 +1,203 @@
 import json
-import pandas as pd
 import os
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from table_store import write_table, read_table, table_exists, DEFAULT_FORMATS
+from go_enrichment import GOIncidence
+from go_dag import GODag, NAMESPACES
+
+GO_CLASSES = {'P': 'Biological Process', 'C': 'Cellular Function', 'F': 'Molecular Function'}
+GO_COLUMNS = ['Gene Ontology ID', 'Protein Name', 'UniProtKB',
+              'Gene Ontology Classification', 'Classification Value']
+# go_ids holds one row per (UniProtKB, GO ID), go_proteins one row per processed accession
+GO_KEY = ['UniProtKB', 'Gene Ontology ID']
+PROTEIN_COLUMNS = ['UniProtKB', 'Protein Name', 'EC Numbers']
+WHITESPACE = re.compile(r'\s*')
+
+
+def streamJSONArray(path: str, key: str = 'results', chunk_size: int = 1 << 20):
+    """
+        Yields the items of one array of a top level JSON object (e.g. the 'results' of
+        go_results.json) one at a time, reading the file chunk_size characters at a time.
+        Only the item being decoded is held in memory, plus the other top level values,
+        which are decoded and dropped.
+
+        Args:
+            path: str
+                path to the JSON file
+            key: str
+                key of the array to stream
+            chunk_size: int
+                number of characters read at a time
+
+        Returns:
+            generator of the decoded items
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as file:
+        buffer, pos, eof = '', 0, False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+
+        def peek():
+            # next non whitespace character, '' at the end of the file
+            nonlocal pos
+            while True:
+                pos = WHITESPACE.match(buffer, pos).end()
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos + 1]
+                fill()
+
+        def expect(char):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"Expected '{char}' at character {file.tell() - len(buffer) + pos} of {path}")
+            pos += 1
+
+        def value():
+            # a number may be cut short by the end of the buffer (e.g. 1e|5 decodes
+            # as 1), so it is only taken once the character after it is in too
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    if eof or (end < len(buffer) and buffer[end] not in '+-.eE0123456789'):
+                        pos = end
+                        return item
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        while peek() != '}':
+            if peek() == ',':
+                pos += 1
+            name = value()
+            expect(':')
+            if name != key:
+                value()
+                continue
+            expect('[')
+            while peek() != ']':
+                if peek() == ',':
+                    pos += 1
+                yield value()
+            pos += 1
+
 
 class GeneOntology:
-    def __init__(self, parent_dir: str, results_path: str):
+    def __init__(self, parent_dir: str, results_path: str, formats: tuple = DEFAULT_FORMATS):
         self.parent_dir = parent_dir
         self.results_path = results_path
+        self.formats = formats
         self.ecNumbers = None
         self.goIDs = None
+        self.goDag = None
 
-    def process_GO_IDs(self):
-        with open(self.results_path + '/go_results.json', 'r', encoding='utf-8') as ifile:
-            results = json.load(ifile)
-        df = pd.DataFrame(columns=['Gene Ontology ID', 'Protein Name', 'UniProtKB',
-                                   'Gene Ontology Classification', 'Classification Value'])
-        ecNumbers = []
-        for entry in results['results']:
+    @staticmethod
+    def flattenResults(entries):
+        """
+            Flatten UniProt ID mapping results into one row per GO cross reference.
+            The rows are collected column by column and the DataFrame is built once.
+
+            Args:
+                entries: iterable of dict
+                    the 'results' of go_results.json, e.g. streamJSONArray(<...>/go_results.json)
+
+            Returns:
+                df: pd.DataFrame with the columns in GO_COLUMNS
+                proteins: pd.DataFrame with the columns in PROTEIN_COLUMNS, one row per
+                    entry. 'EC Numbers' holds the entry's EC numbers joined with ';'
+        """
+        columns = {column: [] for column in GO_COLUMNS}
+        go_ids, prot_names, uniprot_ids, go_classes, go_class_values = columns.values()
+        proteins = {column: [] for column in PROTEIN_COLUMNS}
+        for entry in entries:
             uniprot_id = entry['from']
-            prot_name = entry['to']['proteinDescription']['recommendedName']['fullName']['value']
-            try:
-                temp_nums = entry['to']['proteinDescription']['recommendedName']['ecNumbers']
-                for dictionary in temp_nums:
-                    ecNumbers.append(dictionary['value'])
-            except KeyError:
-                pass
-            for db_entry in entry['to']['uniProtKBCrossReferences']:
+            description = entry['to'].get('proteinDescription', {})
+            names = description.get('recommendedName') or next(iter(description.get('submissionNames', [])), {})
+            prot_name = names.get('fullName', {}).get('value')
+            proteins['UniProtKB'].append(uniprot_id)
+            proteins['Protein Name'].append(prot_name)
+            proteins['EC Numbers'].append(';'.join(x['value'] for x in names.get('ecNumbers', [])))
+
+            for db_entry in entry['to'].get('uniProtKBCrossReferences', []):
                 if db_entry['database'] == 'GO':
-                    go_id = db_entry['id']
                     extracted_val = db_entry['properties'][0]['value']
-                    go_class_value = extracted_val[2:]
-                    if extracted_val[0] == 'P':
-                        go_class = 'Biological Process'
-                    elif extracted_val[0] == 'C':
-                        go_class = 'Cellular Function'
-                    elif extracted_val[0] == 'F':
-                        go_class = 'Molecular Function'
-                    else:
-                        go_class = 'Unknown Class'
+                    go_ids.append(db_entry['id'])
+                    prot_names.append(prot_name)
+                    uniprot_ids.append(uniprot_id)
+                    go_classes.append(GO_CLASSES.get(extracted_val[0], 'Unknown Class'))
+                    go_class_values.append(extracted_val[2:])
+
+        return pd.DataFrame(columns, columns=GO_COLUMNS), pd.DataFrame(proteins, columns=PROTEIN_COLUMNS)
 
-                    df.loc[len(df.index)] = [go_id, prot_name, uniprot_id,
-                                             go_class, go_class_value]
+    def process_GO_IDs(self, refresh: bool = False):
+        """
+            Add the GO terms of go_results.json to the GO ID store in results_path:
+                go_ids       : one row per (UniProtKB, GO ID)
+                go_proteins  : one row per processed accession, with its protein name
+                               and EC numbers
+                ecNumbers.txt: the distinct EC numbers of all processed accessions
 
-        self.goIDs = df
-        self.ecNumbers = ecNumbers
+            Accessions already in go_proteins are skipped, so a re-run only costs the
+            new accessions and leaves the store unchanged if there are none. The rows
+            of re-processed accessions replace their old ones, which makes re-running
+            idempotent.
 
-        if "go_ids.csv" in os.listdir(self.results_path):
-            df = pd.read_csv(self.results_path + "/go_ids.csv")
-            self.goIDs = pd.concat([df, self.goIDs])
+            Args:
+                refresh: bool
+                    re-process every accession in go_results.json, e.g. after
+                    downloading fresh results for accessions already in the store
+        """
+        go_path, proteins_path = self.results_path + '/go_ids', self.results_path + '/go_proteins'
+        goIDs = read_table(go_path) if table_exists(go_path) else pd.DataFrame(columns=GO_COLUMNS)
+        proteins = read_table(proteins_path) if table_exists(proteins_path) \
+            else pd.DataFrame(columns=PROTEIN_COLUMNS)
+        # go_ids.csv files written by to_csv carry their index back as 'Unnamed: 0' column(s)
+        migrated = list(goIDs.columns) != GO_COLUMNS or list(proteins.columns) != PROTEIN_COLUMNS
+        goIDs, proteins = goIDs[GO_COLUMNS], proteins[PROTEIN_COLUMNS]
 
-        self.goIDs.to_csv(self.results_path + '/go_ids.csv')
+        processed = set() if refresh else set(proteins['UniProtKB'])
+        new_goIDs, new_proteins = self.flattenResults(
+            entry for entry in streamJSONArray(self.results_path + '/go_results.json', 'results')
+            if entry['from'] not in processed)
 
-        with open(self.results_path + '/ecNumbers.txt', "a") as f:
-            for x in self.ecNumbers:
-                f.write(x + '\n')
+        if not new_proteins.empty:
+            # an accession can map to several entries, whose rows are all kept
+            new_proteins = new_proteins.groupby('UniProtKB', sort=False).agg(
+                {'Protein Name': 'first',
+                 'EC Numbers': lambda x: ';'.join(dict.fromkeys(y for z in x for y in z.split(';') if y))}
+            ).reset_index()
+            reprocessed = set(new_proteins['UniProtKB'])
+            goIDs = pd.concat([goIDs[~goIDs['UniProtKB'].isin(reprocessed)], new_goIDs], ignore_index=True)
+            proteins = pd.concat([proteins[~proteins['UniProtKB'].isin(reprocessed)], new_proteins],
+                                 ignore_index=True)
+
+        # stores written before go_proteins existed may hold duplicates from earlier runs
+        deduplicated = goIDs.drop_duplicates(GO_KEY, keep='last', ignore_index=True)
+        changed = not new_proteins.empty or len(deduplicated) < len(goIDs) or migrated or not table_exists(go_path)
+        self.goIDs = deduplicated
+        self.ecNumbers = sorted({y for x in proteins['EC Numbers'].dropna() for y in x.split(';') if y})
+
+        if changed:
+            write_table(self.goIDs, go_path, self.formats)
+            write_table(proteins, proteins_path, self.formats)
+            with open(self.results_path + '/ecNumbers.txt', "w") as f:
+                for x in self.ecNumbers:
+                    f.write(x + '\n')
 
         return
 
-    def goClassSplitter(self):
+    def goClassSplitter(self, output_dir: str = None):
         # Read entries from the .csv that links GO ID(s) to geneID(s)
         # The aim is to group up all UniProt ID(s) with the same GO ID
         # and then count the number of Genes associated with a particular
@@ -64,50 +205,139 @@ class GeneOntology:
         # Molecular Functions and Cellular Functions
         # We then want to calculate the scores for each of these subprocesses, defined
         # as - (# genes involved in a subprocess) / (total # of genes)
+        #
+        # All the classes go into one table, go_class_counts, in output_dir (results_path
+        # by default), sorted by class then gene count. Each class is also written to
+        # its own <class>_go_count.csv as before.
 
-        if not self.goIDs and "go_ids.csv" not in os.listdir(self.results_path):
+        if self.goIDs is None and not table_exists(self.results_path + "/go_ids"):
             raise TypeError("No GO IDs present")
-        elif self.goIDs:
-            pass
-        else:
-            self.goIDs = pd.read_csv(self.results_path + "/go_ids.csv")
+        elif self.goIDs is None:
+            self.goIDs = read_table(self.results_path + "/go_ids")
+        output_dir = self.results_path if output_dir is None else output_dir
 
         with open(self.results_path + "/uniprot_freqs.json", "r", encoding="utf-8") as file:
             uniprot_freqs = json.load(file)
 
-        # seperate each gene based on GO Process Class into a dictionary
-        bio_dict, mol_dict, cel_dict = {}, {}, {}
-        uniques_dict = [bio_dict, mol_dict, cel_dict]
+        # accessions that aren't among the genes any more count for nothing
+        gene_counts = self.goIDs['UniProtKB'].map(uniprot_freqs).fillna(0).astype('int64')
         class_match = ['Biological Process', 'Molecular Function', 'Cellular Function']
-        max_vals = [0] * 3
+        go_classes = pd.Categorical(self.goIDs['Gene Ontology Classification'],
+                                    categories=class_match + ['Unknown Class'])
+
+        counts = self.goIDs.assign(**{'Gene Ontology Classification': go_classes, 'Gene Count': gene_counts}) \
+            .groupby(['Gene Ontology Classification', 'Gene Ontology ID'], sort=False, observed=True) \
+            .agg(**{'Metabolic Pathway': ('Classification Value', 'first'), 'Gene Count': ('Gene Count', 'sum')}) \
+            .reset_index()
+        class_totals = counts.groupby('Gene Ontology Classification', observed=True)['Gene Count'].transform('sum')
+        counts['Score'] = (counts['Gene Count'] / class_totals * 100).round(3)
+        counts = counts.sort_values(['Gene Ontology Classification', 'Gene Count'], ascending=[True, False],
+                                    kind='stable', ignore_index=True)
+
+        os.makedirs(output_dir, exist_ok=True)
+        write_table(counts, output_dir + '/go_class_counts', self.formats)
+        for go_class in class_match:
+            uniques_df = counts[counts['Gene Ontology Classification'] == go_class] \
+                .set_index('Gene Ontology ID')[['Metabolic Pathway', 'Gene Count', 'Score']]
+            uniques_df.index.name = None
+            uniques_df.to_csv(output_dir + '/' + go_class.replace(' ', '_').lower() + '_go_count.csv')
+
+        return counts
+
+    def partitionEnrichment(self, genes_path: str = None, output_dir: str = None, correction: str = 'fdr_bh'):
+        """
+            Test every GO term for over-representation in each pangenome partition
+            (persistent, shell, cloud) against all annotated genes. See
+            GOIncidence.enrichment. The results are written to the
+            go_partition_enrichment table in output_dir (results_path by default).
+
+            Args:
+                genes_path: str
+                    gene table written by GeneParser. Defaults to
+                    <parent_dir>/trimmed_matrix_files/genes
+                output_dir: str
+                    directory to write the table to
+                correction: str
+                    'fdr_bh', 'bonferroni' or 'none'
+
+            Returns:
+                pd.DataFrame, one row per partition and GO term
+        """
+        if self.goIDs is None and not table_exists(self.results_path + "/go_ids"):
+            raise TypeError("No GO IDs present")
+        elif self.goIDs is None:
+            self.goIDs = read_table(self.results_path + "/go_ids")
+        genes_path = self.parent_dir + '/trimmed_matrix_files/genes' if genes_path is None else genes_path
+        output_dir = self.results_path if output_dir is None else output_dir
+
+        genes = read_table(genes_path, columns=['Gene ID', 'UniProtKB', 'Partition'])
+        enrichment = GOIncidence.build(genes, self.goIDs).enrichment('Partition', correction)
+
+        os.makedirs(output_dir, exist_ok=True)
+        write_table(enrichment, output_dir + '/go_partition_enrichment', self.formats)
+        return enrichment
+
+    def rollUp(self, obo_path: str, depth: int = None, slim: list = None, output_dir: str = None):
+        """
+            goClassSplitter over the GO graph: every accession counts towards all the
+            ancestors of its GO terms, and the counts are reported for the terms at a
+            given depth of the graph and/or in a slim. Gene counts and scores are
+            defined as in goClassSplitter.
 
-        for index, row in self.goIDs.iterrows():
-            go_id = row.loc['Gene Ontology ID']
-            go_class = class_match.index(row.loc['Gene Ontology Classification'])
+            The graph and its ancestor closure are loaded once (see GODag.load, which
+            caches them next to the OBO file) and kept on the object, so further
+            roll-ups to other depths or slims are sparse products only.
 
-            if go_id in uniques_dict[go_class].keys():
-                uniques_dict[go_class][go_id][1] += uniprot_freqs[row.loc['UniProtKB']]
-                max_vals[go_class] += uniprot_freqs[row.loc['UniProtKB']]
-            else:
-                uniques_dict[go_class].update({go_id: [row.loc['Classification Value'],
-                                                       uniprot_freqs[row.loc['UniProtKB']],
-                                                       0]})
-                max_vals[go_class] += uniprot_freqs[row.loc['UniProtKB']]
+            Args:
+                obo_path: str
+                    local GO OBO file, e.g. go-basic.obo
+                depth: int
+                    only report terms whose longest path to their root has this length
+                slim: list[str]
+                    only report these GO ids
+                output_dir: str
+                    the table is written to <output_dir>/go_rollup (results_path by default)
 
-        # Fill in Scores
-        for go_class in range(len(class_match)):
-            for key in uniques_dict[go_class]:
-                uniques_dict[go_class][key][2] = round(uniques_dict[go_class][key][1] / max_vals[go_class] * 100, 3)
+            Returns:
+                pd.DataFrame with the columns 'Gene Ontology Classification',
+                'Gene Ontology ID', 'Metabolic Pathway', 'Depth', 'Gene Count' and 'Score'
+        """
+        if self.goIDs is None and not table_exists(self.results_path + "/go_ids"):
+            raise TypeError("No GO IDs present")
+        elif self.goIDs is None:
+            self.goIDs = read_table(self.results_path + "/go_ids")
+        if self.goDag is None or self.goDag.obo_path != obo_path:
+            self.goDag = GODag.load(obo_path)
+        output_dir = self.results_path if output_dir is None else output_dir
 
-        for k in range(len(uniques_dict)):
-            uniques_dict[k] = dict(sorted(uniques_dict[k].items(),
-                                          key=lambda kv: kv[1][1], reverse=True))
-            uniques_df = pd.DataFrame.from_dict(uniques_dict[k], orient='index',
-                                                columns=['Metabolic Pathway',
-                                                         'Gene Count', 'Score'])
+        with open(self.results_path + "/uniprot_freqs.json", "r", encoding="utf-8") as file:
+            uniprot_freqs = json.load(file)
 
-            uniques_df.to_csv('/content/drive/MyDrive/geobacillus_pangenome/Gene_Ontology/' +
-                              class_match[k].replace(' ', '_').lower() + '_go_count.csv')
+        go = self.goIDs.drop_duplicates(GO_KEY)
+        accession_codes, accessions = pd.factorize(go['UniProtKB'])
+        term_codes, term_ids = pd.factorize(go['Gene Ontology ID'])
+        annotations = sparse.csr_matrix((np.ones(len(go), dtype=bool), (accession_codes, term_codes)),
+                                        shape=(len(accessions), len(term_ids)))
 
+        targets = self.goDag.select(depth, slim)
+        propagated = self.goDag.propagate(annotations, term_ids)[:, targets]
+        weights = accessions.map(uniprot_freqs).fillna(0).to_numpy(dtype=np.int64)
+        gene_counts = propagated.T.astype(np.int64) @ weights
 
+        class_match = ['Biological Process', 'Molecular Function', 'Cellular Function']
+        go_classes = pd.Categorical(pd.Series(self.goDag.namespaces[targets]).map(NAMESPACES),
+                                    categories=class_match)
+        counts = pd.DataFrame({'Gene Ontology Classification': go_classes,
+                               'Gene Ontology ID': self.goDag.ids[targets],
+                               'Metabolic Pathway': self.goDag.names[targets],
+                               'Depth': self.goDag.depth[targets],
+                               'Gene Count': gene_counts})
+        counts = counts[counts['Gene Count'] > 0]
+        class_totals = counts.groupby('Gene Ontology Classification', observed=True)['Gene Count'].transform('sum')
+        counts = counts.assign(Score=(counts['Gene Count'] / class_totals * 100).round(3)) \
+            .sort_values(['Gene Ontology Classification', 'Gene Count'], ascending=[True, False],
+                         kind='stable', ignore_index=True)
 
+        os.makedirs(output_dir, exist_ok=True)
+        write_table(counts, output_dir + '/go_rollup', self.formats)
+        return counts
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+from table_store import read_table
+
+# Columns of the gene table that repeat a few long strings on every row
+CODED_COLUMNS = ['Organism', 'Gene Family', 'Genome ID', 'Partition']
+
+
+class GeneTable:
+    """
+        Compact in-memory version of the gene table built by GeneParser (genes,
+        recognized, hypotheticals).
+
+        The coded columns are held as int32 codes into per-column vocabularies
+        instead of one python string per row. Strings are only produced when a
+        column is decoded, so filters and groupbys can run on the integer codes.
+        The vocabularies dictionary can be shared between tables (e.g. recognized
+        and hypotheticals, or the genes of several pangenomes) so that a code means
+        the same thing in all of them. New values are only ever appended to a
+        vocabulary, which keeps existing codes valid.
+
+        Attributes:
+        -----------
+        codes: pd.DataFrame
+            'Gene ID', 'UniProtKB' and any other uncoded column as is, plus one int32
+            column of codes per coded column. Missing values are coded as -1.
+        vocabularies: dict[str, pd.Index]
+            coded column name -> unique values. Code i stands for vocabularies[column][i]
+    """
+    def __init__(self, codes: pd.DataFrame, vocabularies: dict):
+        self.codes = codes
+        self.vocabularies = vocabularies
+
+    @classmethod
+    def from_frame(cls, genes: pd.DataFrame, vocabularies: dict = None, coded_columns: list = None):
+        """
+            Encode a gene DataFrame. A 'Gene ID' index is moved back into the columns.
+
+            Args:
+                genes: pd.DataFrame
+                    gene table, e.g. GeneParser.genes or read_table(<...>/genes)
+                vocabularies: dict
+                    vocabularies to encode against (and extend). A new one is made if not given
+                coded_columns: list[str]
+                    columns to encode. Defaults to CODED_COLUMNS
+
+            Returns:
+                GeneTable
+        """
+        table = cls(None, {} if vocabularies is None else vocabularies)
+        genes = genes.reset_index() if 'Gene ID' in genes.index.names else genes
+        coded_columns = CODED_COLUMNS if coded_columns is None else coded_columns
+
+        table.codes = pd.DataFrame({column: table.encode(column, genes[column]) if column in coded_columns
+                                    else genes[column].to_numpy() for column in genes.columns})
+        return table
+
+    @classmethod
+    def read(cls, path: str, vocabularies: dict = None, columns: list = None):
+        """
+            Read and encode a table written by table_store (e.g. <trimmed_matrix_files>/genes).
+        """
+        return cls.from_frame(read_table(path, columns=columns), vocabularies)
+
+    def encode(self, column: str, values) -> np.ndarray:
+        """
+            Turn values of a coded column into codes, adding unseen values to the
+            column's vocabulary. Runs on the distinct values only.
+
+            Returns:
+                np.ndarray of int32 codes, -1 for missing values
+        """
+        values = pd.Series(values, copy=False)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            value_codes, uniques = values.cat.codes.to_numpy(), pd.Index(values.cat.categories)
+        else:
+            value_codes, uniques = pd.factorize(values)
+            uniques = pd.Index(uniques)
+
+        vocabulary = self.vocabularies.get(column)
+        if vocabulary is None:
+            vocabulary = uniques
+        else:
+            vocabulary = vocabulary.append(uniques[~uniques.isin(vocabulary)])
+        self.vocabularies[column] = vocabulary
+
+        # the trailing -1 maps missing values (code -1) to -1
+        mapping = np.append(vocabulary.get_indexer(uniques), -1).astype(np.int32)
+        return mapping[value_codes]
+
+    def code(self, column: str, values):
+        """
+            Codes of a value (or list-like of values) of a coded column, -1 for values
+            that aren't in the vocabulary. Doesn't extend the vocabulary.
+        """
+        if np.ndim(values) == 0:
+            return int(self.vocabularies[column].get_indexer([values])[0])
+        return self.vocabularies[column].get_indexer(values).astype(np.int32)
+
+    def decode(self, column: str, codes=None) -> pd.Series:
+        """
+            Decode a coded column (or an arbitrary array of its codes). The result is a
+            categorical backed by the shared vocabulary, so no per-row strings are built.
+        """
+        if column not in self.vocabularies:
+            return self.codes[column]
+        if codes is None:
+            codes = self.codes[column].to_numpy()
+        return pd.Series(pd.Categorical.from_codes(codes, categories=self.vocabularies[column]), name=column)
+
+    def __getitem__(self, column: str) -> pd.Series:
+        return self.decode(column)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def select(self, column: str, values, missing: bool = False):
+        """
+            Keep the rows whose column matches a value (or any of a list of values),
+            e.g. table.select('Partition', 'persistent'). Coded columns are matched on
+            their integer codes.
+
+            Args:
+                column: str
+                    column to match
+                values: value or list-like of values
+                    values to keep. Values that aren't in the vocabulary match no row
+                missing: bool
+                    also keep the rows where the column is missing
+
+            Returns:
+                GeneTable sharing this table's vocabularies
+        """
+        values = [values] if np.ndim(values) == 0 else values
+        if column in self.vocabularies:
+            # -1 stands for both unknown values and missing values
+            values = self.code(column, values)
+            values = values[values >= 0]
+            keep = self.codes[column].isin(values).to_numpy()
+            if missing:
+                keep |= self.codes[column].to_numpy() == -1
+        else:
+            keep = self.codes[column].isin(values).to_numpy()
+            if missing:
+                keep |= self.codes[column].isna().to_numpy()
+        return self.take(keep)
+
+    def take(self, rows) -> 'GeneTable':
+        """
+            Subset of the rows (boolean mask or positions), sharing the vocabularies.
+        """
+        rows = np.asarray(rows)
+        codes = self.codes[rows] if rows.dtype == bool else self.codes.iloc[rows]
+        return GeneTable(codes.reset_index(drop=True), self.vocabularies)
+
+    def count(self, column: str) -> pd.Series:
+        """
+            Number of genes per value of a coded column, counted on the codes.
+        """
+        codes = self.codes[column].to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.vocabularies[column]))
+        return pd.Series(counts, index=self.vocabularies[column], name=column)
+
+    def to_frame(self, columns: list = None) -> pd.DataFrame:
+        """
+            Decode back into a regular gene DataFrame (coded columns as categoricals).
+        """
+        columns = self.codes.columns.to_list() if columns is None else columns
+        return pd.DataFrame({column: self.decode(column).to_numpy() for column in columns})
@@ -0,0 +1,217 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# OBO namespaces -> the GO classes used in the GO ID store
+NAMESPACES = {'biological_process': 'Biological Process', 'molecular_function': 'Molecular Function',
+              'cellular_component': 'Cellular Function'}
+RELATIONSHIPS = ('is_a', 'part_of')
+
+
+def read_obo(path: str, relationships: tuple = RELATIONSHIPS):
+    """
+        Read the [Term] stanzas of an OBO file (e.g. go-basic.obo).
+
+        Args:
+            path: str
+                path to the OBO file
+            relationships: tuple[str]
+                edges to follow up the graph, 'is_a' and/or any 'relationship:' type
+
+        Returns:
+            terms: pd.DataFrame with one row per term and the columns 'id', 'name',
+                'namespace' and 'obsolete'
+            edges: list of (child id, parent id)
+            alt_ids: dict, alternative id -> id
+    """
+    terms, edges, alt_ids = [], [], {}
+    term = None
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('['):
+                term = {'id': None, 'name': None, 'namespace': None, 'obsolete': False} \
+                    if line == '[Term]' else None
+                if term is not None:
+                    terms.append(term)
+                continue
+            if term is None or ':' not in line:
+                continue
+            tag, _, value = line.partition(':')
+            if tag == 'name':
+                term['name'] = value.strip()
+                continue
+            # drop trailing comments, e.g. is_a: GO:0008150 ! biological_process
+            value = value.split('!')[0].strip()
+            if tag in ('id', 'namespace'):
+                term[tag] = value
+            elif tag == 'is_obsolete':
+                term['obsolete'] = value == 'true'
+            elif tag == 'alt_id':
+                alt_ids[value] = term['id']
+            elif tag == 'is_a' and 'is_a' in relationships:
+                edges.append((term['id'], value.split()[0]))
+            elif tag == 'relationship':
+                relationship, parent = value.split()[:2]
+                if relationship in relationships:
+                    edges.append((term['id'], parent))
+    return pd.DataFrame(terms, columns=['id', 'name', 'namespace', 'obsolete']), edges, alt_ids
+
+
+class GODag:
+    """
+        The GO graph as arrays, with its transitive closure precomputed.
+
+        Term i is ids[i]. ancestors is a sparse terms x terms matrix with a 1 at (i, j)
+        when j is i or one of its ancestors, so propagating annotations up the graph
+        to every ancestor is a single sparse product, and the graph is never walked
+        again once the closure has been built. The arrays are cached next to the OBO
+        file and reloaded as long as the OBO file doesn't change.
+
+        Attributes:
+        -----------
+        ids, names, namespaces: np.ndarray[str]
+            per term
+        obsolete: np.ndarray[bool]
+            per term
+        depth: np.ndarray[int]
+            length of the longest path from the term up to its root (roots are 0)
+        ancestors: scipy.sparse.csr_matrix
+            boolean terms x terms transitive closure, reflexive
+        index: pd.Series
+            id (or alternative id) -> term number, see codes
+        obo_path: str
+            the OBO file the graph was loaded from, if any
+    """
+    def __init__(self, ids, names, namespaces, obsolete, depth, ancestors, alt_ids: dict = None):
+        self.ids = ids
+        self.names = names
+        self.namespaces = namespaces
+        self.obsolete = obsolete
+        self.depth = depth
+        self.ancestors = ancestors
+        self.alt_ids = {} if alt_ids is None else alt_ids
+        self.obo_path = None
+
+        positions = pd.Series(np.arange(len(ids)), index=ids)
+        alternatives = pd.Series(positions.reindex(list(self.alt_ids.values())).to_numpy(),
+                                 index=list(self.alt_ids.keys())).dropna().astype(int)
+        self.index = pd.concat([positions, alternatives[~alternatives.index.isin(positions.index)]])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_obo(cls, path: str, relationships: tuple = RELATIONSHIPS):
+        """
+            Build the graph and its closure from an OBO file.
+        """
+        terms, edges, alt_ids = read_obo(path, relationships)
+        positions = pd.Index(terms['id'])
+        edges = np.array(edges, dtype=str).reshape(-1, 2)
+        edges = np.stack([positions.get_indexer(edges[:, 0]), positions.get_indexer(edges[:, 1])], axis=1)
+        edges = edges[(edges >= 0).all(axis=1)]
+        n_terms = len(terms)
+        parents = sparse.csr_matrix((np.ones(len(edges), dtype=bool), (edges[:, 0], edges[:, 1])),
+                                    shape=(n_terms, n_terms))
+
+        # reflexive closure by repeated squaring: after k rounds it holds every path of
+        # length < 2^k, so it takes log2(depth of the graph) sparse products
+        closure = (parents + sparse.identity(n_terms, dtype=bool, format='csr')).tocsr()
+        while True:
+            squared = (closure @ closure).tocsr()
+            if squared.nnz == closure.nnz:
+                break
+            closure = squared
+
+        # longest path to a root, one sweep per level
+        depth = np.zeros(n_terms, dtype=np.int32)
+        if len(edges):
+            while True:
+                updated = depth.copy()
+                np.maximum.at(updated, edges[:, 0], depth[edges[:, 1]] + 1)
+                if np.array_equal(updated, depth):
+                    break
+                depth = updated
+
+        return cls(terms['id'].to_numpy(dtype=str), terms['name'].fillna('').to_numpy(dtype=str),
+                   terms['namespace'].fillna('').to_numpy(dtype=str), terms['obsolete'].to_numpy(dtype=bool),
+                   depth, closure, alt_ids)
+
+    @classmethod
+    def load(cls, obo_path: str, cache_path: str = None, relationships: tuple = RELATIONSHIPS):
+        """
+            Load the graph from its cache (<obo_path>.closure.npz by default), building
+            and caching it first if the cache is missing or was built from another
+            version of the OBO file.
+        """
+        cache_path = obo_path + '.closure.npz' if cache_path is None else cache_path
+        stat = os.stat(obo_path)
+        fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        relationship_key = np.array(sorted(relationships), dtype=str)
+
+        if os.path.exists(cache_path):
+            # closed before returning, or before the cache is rewritten below
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached['fingerprint'], fingerprint) \
+                        and np.array_equal(cached['relationships'], relationship_key):
+                    n_terms = len(cached['ids'])
+                    ancestors = sparse.csr_matrix(
+                        (np.ones(len(cached['ancestor_indices']), dtype=bool), cached['ancestor_indices'],
+                         cached['ancestor_indptr']), shape=(n_terms, n_terms))
+                    dag = cls(cached['ids'], cached['names'], cached['namespaces'], cached['obsolete'],
+                              cached['depth'], ancestors, dict(zip(cached['alt_ids'], cached['alt_targets'])))
+                    dag.obo_path = obo_path
+                    return dag
+
+        dag = cls.from_obo(obo_path, relationships)
+        np.savez_compressed(cache_path, fingerprint=fingerprint, relationships=relationship_key, ids=dag.ids,
+                            names=dag.names, namespaces=dag.namespaces, obsolete=dag.obsolete, depth=dag.depth,
+                            ancestor_indptr=dag.ancestors.indptr, ancestor_indices=dag.ancestors.indices,
+                            alt_ids=np.array(list(dag.alt_ids.keys()), dtype=str),
+                            alt_targets=np.array(list(dag.alt_ids.values()), dtype=str))
+        dag.obo_path = obo_path
+        return dag
+
+    def codes(self, ids) -> np.ndarray:
+        """
+            Term numbers of GO ids (alternative ids are resolved), -1 for unknown ids.
+        """
+        return self.index.reindex(pd.Index(ids)).fillna(-1).to_numpy(dtype=np.int64)
+
+    def propagate(self, matrix: sparse.spmatrix, ids) -> sparse.csr_matrix:
+        """
+            Propagate annotations up the graph.
+
+            Args:
+                matrix: scipy.sparse matrix
+                    rows x terms annotation matrix (e.g. GOIncidence.matrix)
+                ids: list-like of str
+                    the GO id of every column of matrix. Columns of unknown ids are dropped
+
+            Returns:
+                boolean rows x len(self) csr_matrix, true where a row is annotated with
+                the term or one of its descendants
+        """
+        codes = self.codes(ids)
+        known = np.flatnonzero(codes >= 0)
+        to_dag = sparse.csr_matrix((np.ones(len(known), dtype=bool), (known, codes[known])),
+                                   shape=(matrix.shape[1], len(self)))
+        return (sparse.csr_matrix(matrix, dtype=bool) @ to_dag @ self.ancestors).tocsr()
+
+    def select(self, depth: int = None, slim=None) -> np.ndarray:
+        """
+            Term numbers of a roll-up target: the terms at depth (longest path from the
+            root), the terms of a slim (list of GO ids), or both. All the non obsolete
+            terms if neither is given.
+        """
+        selected = ~self.obsolete
+        if depth is not None:
+            selected &= self.depth == depth
+        if slim is not None:
+            codes = self.codes(slim)
+            in_slim = np.zeros(len(self), dtype=bool)
+            in_slim[codes[codes >= 0]] = True
+            selected &= in_slim
+        return np.flatnonzero(selected)
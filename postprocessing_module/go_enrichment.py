@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import gammaln
+from gene_table import GeneTable
+
+CORRECTIONS = ('fdr_bh', 'bonferroni', 'none')
+
+
+def log_choose(n, k):
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeom_sf(k, N, K, n) -> np.ndarray:
+    """
+        P(X >= k) for X hypergeometric: n draws without replacement from N genes of
+        which K carry the term. Arguments broadcast against each other.
+
+        The tails of all the tests are summed exactly in one pass: the terms of every
+        tail are laid out back to back in one array and summed per test with
+        np.logaddexp.reduceat, so the work is the total length of the tails (at most
+        K per test) and there is no python loop over the tests. scipy's
+        hypergeom.sf loops over its arguments in python, which takes seconds for a
+        few thousand GO terms.
+
+        Returns:
+            np.ndarray of p-values, with the broadcast shape of the arguments
+    """
+    k, N, K, n = np.broadcast_arrays(*(np.asarray(x, dtype=np.int64) for x in (k, N, K, n)))
+    shape = k.shape
+    k, N, K, n = k.ravel(), N.ravel(), K.ravel(), n.ravel()
+
+    start = np.maximum(k, np.maximum(0, n - (N - K)))
+    lengths = np.maximum(np.minimum(n, K) - start + 1, 0)
+    # a tail that starts at the lowest possible value is the whole distribution
+    lengths[k <= 0] = 0
+    pvalues = np.where(k <= 0, 1.0, 0.0)
+
+    tests = np.flatnonzero(lengths)
+    if len(tests):
+        lengths = lengths[tests]
+        offsets = np.cumsum(lengths) - lengths
+        owner = np.repeat(tests, lengths)
+        x = start[owner] + np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+        log_pmf = log_choose(K[owner], x) + log_choose(N[owner] - K[owner], n[owner] - x) \
+            - log_choose(N[owner], n[owner])
+        pvalues[tests] = np.minimum(np.exp(np.logaddexp.reduceat(log_pmf, offsets)), 1.0)
+    return pvalues.reshape(shape)
+
+
+def adjust_pvalues(pvalues: np.ndarray, method: str = 'fdr_bh') -> np.ndarray:
+    """
+        Multiple testing correction along the last axis, so every row of a 2D array is
+        corrected as its own family of tests.
+
+        Args:
+            pvalues: np.ndarray
+                p-values, one family of tests per row
+            method: str
+                'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or 'none'
+
+        Returns:
+            np.ndarray of adjusted p-values, same shape as pvalues
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    n_tests = pvalues.shape[-1]
+    if method == 'none' or n_tests == 0:
+        return pvalues.copy()
+    if method == 'bonferroni':
+        return np.minimum(pvalues * n_tests, 1.0)
+    if method != 'fdr_bh':
+        raise ValueError(f"Unknown correction {method}. Pick from {CORRECTIONS}")
+
+    order = np.argsort(pvalues, axis=-1, kind='stable')
+    ranked = np.take_along_axis(pvalues, order, axis=-1) * n_tests / np.arange(1, n_tests + 1)
+    # q-values are the running minimum from the largest p-value down
+    ranked = np.minimum(np.minimum.accumulate(ranked[..., ::-1], axis=-1)[..., ::-1], 1.0)
+    adjusted = np.empty_like(ranked)
+    np.put_along_axis(adjusted, order, ranked, axis=-1)
+    return adjusted
+
+
+class GOIncidence:
+    """
+        Sparse genes x GO terms incidence matrix, built by joining the gene table
+        (Gene ID, UniProtKB, Partition) with the GO ID store (UniProtKB, GO ID) on
+        UniProtKB. A gene is annotated with every GO term of its UniProtKB accession.
+
+        Counting genes per term for any grouping of the genes (partitions, organisms,
+        ...) is then one sparse product of a group indicator matrix with the incidence
+        matrix, for all the terms at once.
+
+        Attributes:
+        -----------
+        genes: GeneTable
+            the genes, one per row of matrix, with their coded grouping columns
+        terms: pd.DataFrame
+            one row per column of matrix, indexed by 'Gene Ontology ID', with the
+            'Gene Ontology Classification' and 'Classification Value' of the term
+        matrix: scipy.sparse.csr_matrix
+            int32 genes x terms matrix, 1 where the gene is annotated with the term
+    """
+    def __init__(self, genes: GeneTable, terms: pd.DataFrame, matrix: sparse.csr_matrix):
+        self.genes = genes
+        self.terms = terms
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, genes, go_ids: pd.DataFrame, group_columns: list = None):
+        """
+            Args:
+                genes: pd.DataFrame or GeneTable
+                    gene table with 'Gene ID', 'UniProtKB' and the group columns, e.g.
+                    read_table(<trimmed_matrix_files>/genes)
+                go_ids: pd.DataFrame
+                    GO ID store as written by GeneOntology.process_GO_IDs
+                group_columns: list[str]
+                    columns the genes can be grouped by in enrichment. Defaults to ['Partition']
+
+            Returns:
+                GOIncidence
+        """
+        group_columns = ['Partition'] if group_columns is None else group_columns
+        if not isinstance(genes, GeneTable):
+            genes = GeneTable.from_frame(genes[['Gene ID', 'UniProtKB'] + group_columns],
+                                         coded_columns=group_columns)
+
+        go_ids = go_ids.drop_duplicates(['UniProtKB', 'Gene Ontology ID'])
+        term_codes, term_ids = pd.factorize(go_ids['Gene Ontology ID'])
+        accessions = pd.Index(go_ids['UniProtKB'].unique())
+        terms = go_ids.groupby('Gene Ontology ID', sort=False)[
+            ['Gene Ontology Classification', 'Classification Value']].first().reindex(term_ids)
+
+        # genes x accessions, one accession per gene at most, times accessions x terms
+        gene_accessions = accessions.get_indexer(genes.codes['UniProtKB'].astype(str))
+        rows = np.flatnonzero(gene_accessions >= 0)
+        gene_matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, gene_accessions[rows])),
+                                        shape=(len(genes), len(accessions)))
+        accession_matrix = sparse.csr_matrix((np.ones(len(term_codes), dtype=np.int32),
+                                              (accessions.get_indexer(go_ids['UniProtKB']), term_codes)),
+                                             shape=(len(accessions), len(term_ids)))
+        return cls(genes, terms, (gene_matrix @ accession_matrix).tocsr())
+
+    def annotated(self) -> np.ndarray:
+        """
+            Boolean mask of the genes with at least one GO term.
+        """
+        return np.diff(self.matrix.indptr) > 0
+
+    def group_counts(self, column: str = 'Partition', genes: np.ndarray = None):
+        """
+            Number of genes annotated with each term, per value of a coded column.
+
+            Args:
+                column: str
+                    coded column of genes to group by
+                genes: np.ndarray
+                    boolean mask of the genes to count. Defaults to all of them
+
+            Returns:
+                counts: np.ndarray, groups x terms
+                group_sizes: np.ndarray, number of counted genes per group
+        """
+        codes = self.genes.codes[column].to_numpy()
+        keep = codes >= 0 if genes is None else (codes >= 0) & genes
+        rows = np.flatnonzero(keep)
+        groups = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (codes[rows], rows)),
+                                   shape=(len(self.genes.vocabularies[column]), len(self.genes)))
+        return (groups @ self.matrix).toarray(), np.asarray(groups.sum(axis=1)).ravel()
+
+    def enrichment(self, column: str = 'Partition', correction: str = 'fdr_bh',
+                   universe: str = 'annotated') -> pd.DataFrame:
+        """
+            One-sided hypergeometric test for the over-representation of every GO term
+            in every group (e.g. persistent, shell and cloud) against all the groups
+            together, run for all groups and terms in one batch of array operations.
+
+            Args:
+                column: str
+                    coded column of genes to group by
+                correction: str
+                    multiple testing correction applied over the terms of each group,
+                    'fdr_bh', 'bonferroni' or 'none'
+                universe: str
+                    'annotated' to only count genes with at least one GO term (the usual
+                    background), 'all' to count every gene
+
+            Returns:
+                pd.DataFrame, one row per group and tested term (terms with no gene in
+                the universe are left out), sorted by group then p-value. 'Genes' is
+                the number of genes of the group with the term, 'Group Genes' the size
+                of the group, 'Term Genes' the number of genes with the term and
+                'Universe' the number of genes, all within the universe.
+        """
+        if universe not in ('annotated', 'all'):
+            raise ValueError(f"Unknown universe {universe}. Pick from ('annotated', 'all')")
+        counts, group_sizes = self.group_counts(column, self.annotated() if universe == 'annotated' else None)
+        term_sizes = counts.sum(axis=0)
+        tested = term_sizes > 0
+        counts, term_sizes = counts[:, tested], term_sizes[tested]
+        n_universe = group_sizes.sum()
+
+        pvalues = hypergeom_sf(counts, n_universe, term_sizes[None, :], group_sizes[:, None])
+        qvalues = adjust_pvalues(pvalues, correction)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fold = (counts / group_sizes[:, None]) / (term_sizes / n_universe)
+
+        n_groups, n_terms = counts.shape
+        terms = self.terms[tested]
+        result = pd.DataFrame({
+            column: self.genes.decode(column, np.repeat(np.arange(n_groups), n_terms)).to_numpy(),
+            'Gene Ontology ID': np.tile(terms.index.to_numpy(), n_groups),
+            'Gene Ontology Classification': np.tile(terms['Gene Ontology Classification'].to_numpy(), n_groups),
+            'Classification Value': np.tile(terms['Classification Value'].to_numpy(), n_groups),
+            'Genes': counts.ravel(),
+            'Group Genes': np.repeat(group_sizes, n_terms),
+            'Term Genes': np.tile(term_sizes, n_groups),
+            'Universe': n_universe,
+            'Fold Enrichment': fold.ravel(),
+            'P Value': pvalues.ravel(),
+            'Q Value': qvalues.ravel()})
+        # groups with no gene in the universe have nothing to test
+        result = result[result['Group Genes'] > 0]
+        return result.sort_values([column, 'P Value'], kind='stable', ignore_index=True)
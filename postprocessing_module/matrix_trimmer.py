@@ -1,8 +1,15 @@
 import pandas as pd
 import json
+import io
+import mmap
+import os
+import sqlite3
+import tempfile
 import numpy as np
-from tqdm import tqdm
 import multiprocess as mp
+import pyarrow as pa
+import pyarrow.parquet as pq
+from table_store import TableWriter, write_table, read_table, iter_table, DEFAULT_FORMATS
 
 class GeneParser:
     """
@@ -16,6 +23,8 @@ class GeneParser:
         ppan_dir: str
             path to the ppanggolin generated dataset
         uniprot_path
+        formats: tuple[str]
+            formats the tables are written in, any of 'parquet' and 'csv'. See table_store.py
 
         Storage Tree:
 
@@ -26,17 +35,20 @@ class GeneParser:
                     /                           \
                    /                             \
                   /                               \
-                matrix                      genes.csv ; hypothetical.csv ; recognized.csv ; gff_seqeuencing.csv
+                matrix                      genes ; hypotheticals ; recognized ; gff_sequencing
+                                                    (.parquet and/or .csv)
 
 
 
     """
-    def __init__(self, parent_path: str, ppan_dir: str, uniprot_path: str):
+    def __init__(self, parent_path: str, ppan_dir: str, uniprot_path: str, formats: tuple = DEFAULT_FORMATS):
         self.parent_path = parent_path if parent_path[-1] == '/' else parent_path + '/'
         self.ppan_dir = parent_path + "PPaNGGOLiN_RUN/"
         self.matrix_path = self.ppan_dir + '/matrix/matrix.csv'
         self.parsed_genedata_path = self.parent_path + '/trimmed_matrix_files/'
         self.uniprot_path = self.parsed_genedata_path
+        self.formats = formats
+        self.genes = None
 
     def parseGenes(self):
         """
@@ -51,127 +63,263 @@ class GeneParser:
 
             In addition, it links up UniProtIDs for each gene listed.
 
-            Saves the generated table as genes.csv.
+            Saves the generated table as genes (see table_store.py).
 
             Returns: None
 
         """
         matrix = pd.read_csv(self.matrix_path)
-        self.genes = pd.DataFrame(columns=['Gene ID', 'Organism', 'Gene Family', 'Genome ID', 'UniProtKB', 'Partition'])
-
-        organism_idx = list(
-            range(matrix.columns.to_list().index('Avg group size nuc') + 1, len(matrix.columns.to_list())))
-        matrix_cols = matrix.columns.to_numpy()
-        matrix = matrix.to_numpy()
-        pbar = tqdm(total=matrix.shape[0] * matrix.shape[1])    # progress bar
-
-        for row in range(0, matrix.shape[0]):
-            for col in organism_idx:
-                gene_family = matrix[row, 0]
-                genome = gene_family.split('_')[0]
-                organism = matrix_cols[col]
-                partition = matrix[row, 1]
-                uniprot = None
-                # skip if the organism doesn't share a gene with family
-                if pd.isna(matrix[row, col]):
-                    continue
-                # it may share a list of genes, split them and process each one
-                gene_list = str(matrix[row, col]).replace('\"', "").split(' ')
-                for gene in gene_list:
-                    self.genes.loc[len(self.genes.index)] = [gene, organism, gene_family, genome, uniprot, partition]
-                pbar.update(1)
-        pbar.close()
+        self.genes = self.explodeMatrix(matrix)
 
         self.linkUniProt()
         self.genes.set_index('Gene ID', inplace=True)
-        self.genes.to_csv(self.parsed_genedata_path + 'genes.csv')
-
-    def parseGenes_mp(self):
-        """
-        Multiprocess version of the above code.
-
-        TODO Not complete. Experimental version
-        """
-        whole_matrix = pd.read_csv(self.matrix_path)
-        output = pd.DataFrame(columns=['Gene ID', 'Organism', 'Gene Family', 'Genome ID', 'UniProtKB', 'Partition'])
-
-        def splitGenes(idx, matrix):
-            out_df = pd.DataFrame(columns=['Gene ID', 'Organism', 'Gene Family', 'Genome ID', 'UniProtKB', 'Partition'])
-            pbar = tqdm(total=matrix.shape[0] * matrix.shape[1])
-            for row in range(0, matrix.shape[0]):
-                for col in organism_idx:
-                    gene_family = matrix[row, 0]
-                    genome = gene_family.split('_')[0]
-                    organism = matrix_cols[col]
-                    partition = matrix[row, 1]
-                    uniprot = ""
-
-                    # skip if the organism doesn't share a gene with family
-                    if pd.isna(matrix[row, col]):
-                        continue
-                    # it may share a list of genes, split them and process each one
-                    gene_list = str(matrix[row, col]).replace('\"', "").split(' ')
-                    for gene in gene_list:
-                        out_df.loc[len(out_df.index)] = [gene, organism, gene_family,
-                                                         genome, uniprot, partition]
-                    pbar.update(1)
-
-            pbar.close()
-            # output.set_index('Gene ID', inplace=True)
-            # output.to_csv(self.parsed_genedata_path + f'filtered_matrix_{idx}.csv')
-            return out_df
-
-        organism_idx = list(
-            range(whole_matrix.columns.to_list().index('Avg group size nuc') + 1, len(whole_matrix.columns.to_list())))
-        matrix_cols = whole_matrix.columns.to_numpy()
-        whole_matrix = whole_matrix.to_numpy()
-        max_rows = whole_matrix.shape[0]
-        cpus = mp.cpu_count()
-        input(f"Found {cpus} CPU Cores. Hit Enter to continue...")
-        splits = [x * max_rows // cpus for x in range(cpus)] + [max_rows]
-
-        with mp.Pool() as p:
-            return_val = p.starmap(splitGenes, [(x, whole_matrix[splits[x]:splits[x + 1]]) for x in range(0, 5)])
-
-        output = pd.concat([output]+return_val, axis=0, ignore_index=True)
-        self.genes = output
+        write_table(self.genes, self.parsed_genedata_path + 'genes', self.formats)
+
+    @staticmethod
+    def explodeMatrix(matrix: pd.DataFrame) -> pd.DataFrame:
+        """
+            Vectorized core of parseGenes. Melts the organism columns of a (slice of a)
+            matrix file into one (gene family, organism) cell per row, splits the
+            space-separated gene lists in those cells and explodes them into one gene
+            per row.
+
+            Rows come out in the same order the nested row/organism/gene loops would
+            produce them, i.e. family by family, organisms in column order.
+
+            Args:
+                matrix: pd.DataFrame
+                    matrix.csv as read by pandas (or any row slice of it)
+
+            Returns:
+                pd.DataFrame with columns 'Gene ID', 'Organism', 'Gene Family',
+                'Genome ID', 'UniProtKB' and 'Partition'
+        """
+        columns = matrix.columns.to_list()
+        organism_cols = columns[columns.index('Avg group size nuc') + 1:]
+        family_col, partition_col = columns[0], columns[1]
+
+        # stack drops the empty cells (organism doesn't share a gene with family)
+        cells = matrix.set_index([family_col, partition_col])[organism_cols].stack()
+        gene_lists = cells.astype(str).str.replace('"', '', regex=False).str.split(' ')
+        exploded = gene_lists.explode()
+
+        gene_families = exploded.index.get_level_values(0)
+        return pd.DataFrame({
+            'Gene ID': exploded.to_numpy(),
+            'Organism': exploded.index.get_level_values(2),
+            'Gene Family': gene_families,
+            'Genome ID': gene_families.str.split('_').str[0],
+            'UniProtKB': None,
+            'Partition': exploded.index.get_level_values(1),
+        })
+
+    def parseGenes_mp(self, cpus: int = None):
+        """
+            Multiprocess version of parseGenes. Produces exactly the same genes table.
+
+            The matrix file is cut into one contiguous byte range per worker, aligned on
+            line boundaries. Each worker memory-maps matrix.csv and parses only its own
+            range, so the matrix is never pickled across to the pool; only the
+            (start, end) offsets are. Likewise each worker writes its genes to a parquet
+            part file and only sends back the part's path: pickling the exploded
+            DataFrame through multiprocess (dill) costs more than parsing it. Parts are
+            concatenated in range order, which keeps the output order deterministic.
+
+            Note: relies on PPanGGOLiN never writing newlines inside quoted fields.
+
+            Args:
+                cpus: int
+                    number of worker processes. Defaults to mp.cpu_count()
+
+            Returns: None
+        """
+        cpus = mp.cpu_count() if cpus is None else cpus
+        if cpus < 1:
+            raise ValueError(f"cpus must be a positive integer, got {cpus}")
+
+        with open(self.matrix_path, 'rb') as file:
+            columns = pd.read_csv(file, nrows=0).columns.to_list()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as matrix_map:
+                body_start, file_size = matrix_map.find(b'\n') + 1, matrix_map.size()
+                # align each split on the start of the next line
+                splits = [body_start]
+                for x in range(1, cpus):
+                    offset = matrix_map.find(b'\n', body_start + x * (file_size - body_start) // cpus)
+                    splits.append(file_size if offset == -1 else offset + 1)
+                splits.append(file_size)
+
+        matrix_path = self.matrix_path
+        os.makedirs(self.parsed_genedata_path, exist_ok=True)
+
+        def splitGenes(start, end, part_path):
+            with open(matrix_path, 'rb') as matrix_file, \
+                    mmap.mmap(matrix_file.fileno(), 0, access=mmap.ACCESS_READ) as matrix_map:
+                matrix = pd.read_csv(io.BytesIO(matrix_map[start:end]), header=None, names=columns)
+            pq.write_table(pa.Table.from_pandas(GeneParser.explodeMatrix(matrix), preserve_index=False),
+                           part_path)
+            return part_path
+
+        with tempfile.TemporaryDirectory(dir=self.parsed_genedata_path) as parts_dir:
+            ranges = [(splits[x], splits[x + 1], f"{parts_dir}/part_{x}.parquet")
+                      for x in range(cpus) if splits[x] < splits[x + 1]]
+            with mp.Pool(processes=min(cpus, max(len(ranges), 1))) as p:
+                part_paths = p.starmap(splitGenes, ranges)
+
+            if part_paths:
+                # promote lets the all-null UniProtKB column (and empty parts) line up
+                self.genes = pa.concat_tables([pq.read_table(x) for x in part_paths], promote=True).to_pandas()
+            else:
+                self.genes = pd.DataFrame(columns=['Gene ID', 'Organism', 'Gene Family', 'Genome ID',
+                                                   'UniProtKB', 'Partition'])
         self.linkUniProt()
         self.genes.set_index('Gene ID', inplace=True)
-        self.genes.to_csv(self.parsed_genedata_path + 'genes.csv')
+        write_table(self.genes, self.parsed_genedata_path + 'genes', self.formats)
+
+    def parseGenes_stream(self, chunksize: int = 1000):
+        """
+            Bounded-memory version of parseGenes for pangenomes whose matrix doesn't fit in
+            memory. matrix.csv is read <chunksize> gene families at a time; each chunk is
+            exploded, linked to its UniProtKB(s) and appended to the genes table before the
+            next one is read. The Gene ID -> UniProtKB pairs of gff_sequencing, which has one
+            row per gene too, are streamed into an on-disk SQLite index first (see
+            indexUniProtDB) and every chunk only looks up its own genes. Peak memory is
+            therefore set by chunksize (times the number of organisms), not by the size of
+            the pangenome.
+
+            The output file is the same as the one written by parseGenes. self.genes is
+            left as None since the full table is never held in memory.
+
+            Args:
+                chunksize: int
+                    number of matrix rows (gene families) held in memory at a time
+
+            Returns: None
+        """
+        if chunksize < 1:
+            raise ValueError(f"chunksize must be a positive integer, got {chunksize}")
+
+        os.makedirs(self.parsed_genedata_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.parsed_genedata_path) as index_dir:
+            uniprot_index = self.indexUniProtDB(index_dir + '/uniprot_db.sqlite')
+            try:
+                with TableWriter(self.parsed_genedata_path + 'genes', self.formats) as writer:
+                    empty = True
+                    for matrix in pd.read_csv(self.matrix_path, chunksize=chunksize):
+                        self.genes = self.explodeMatrix(matrix)
+                        self.linkUniProt(self.lookupUniProt(uniprot_index, self.genes['Gene ID']))
+                        self.genes.set_index('Gene ID', inplace=True)
+                        writer.write(self.genes)
+                        empty = False
+                    if empty:
+                        writer.write(pd.DataFrame(columns=['Gene ID', 'Organism', 'Gene Family', 'Genome ID',
+                                                           'UniProtKB', 'Partition']).set_index('Gene ID'))
+            finally:
+                uniprot_index.close()
+        self.genes = None
+
+    def loadUniProtDB(self, sources: list = None) -> pd.DataFrame:
+        """
+        Builds the Gene ID -> UniProtKB table out of one or more gff_sequencing tables
+        (e.g. shards written for different batches of genomes). Only the two columns needed
+        for the join are read. If a gene shows up in more than one source, the last
+        source wins.
+
+        Args:
+            sources: list[str]
+                paths of the gff_sequencing tables (.parquet or .csv) to link against.
+                Defaults to gff_sequencing in the trimmed matrix directory
+
+        Returns:
+            pd.DataFrame with columns 'Gene ID' and 'UniProtKB', unique on 'Gene ID'
+        """
+        if sources is None:
+            sources = [self.uniprot_path + '/gff_sequencing']
+        uniprot_db = pd.concat([read_table(source, columns=['Gene ID', 'UniProtKB']) for source in sources],
+                               axis=0, ignore_index=True)
+        return uniprot_db.drop_duplicates(subset='Gene ID', keep='last')
+
+    def indexUniProtDB(self, db_path: str, sources: list = None, batch_size: int = 100000) -> sqlite3.Connection:
+        """
+        On-disk version of loadUniProtDB. The Gene ID -> UniProtKB pairs of the
+        gff_sequencing table(s) are streamed <batch_size> rows at a time into an SQLite
+        table keyed on Gene ID, so they never have to fit in memory. As in loadUniProtDB,
+        if a gene shows up in more than one source, the last source wins.
+
+        Args:
+            db_path: str
+                file to build the index in
+            sources: list[str]
+                see loadUniProtDB
+            batch_size: int
+                number of gff_sequencing rows held in memory at a time
 
-    def linkUniProt(self):
+        Returns:
+            sqlite3.Connection to the index, see lookupUniProt
+        """
+        if sources is None:
+            sources = [self.uniprot_path + '/gff_sequencing']
+        cnx = sqlite3.connect(db_path)
+        cnx.execute('PRAGMA journal_mode = OFF')
+        cnx.execute('PRAGMA synchronous = OFF')
+        cnx.execute('CREATE TABLE uniprot_db ("Gene ID" TEXT PRIMARY KEY, "UniProtKB" TEXT) WITHOUT ROWID')
+        with cnx:
+            for source in sources:
+                for batch in iter_table(source, columns=['Gene ID', 'UniProtKB'], batch_size=batch_size):
+                    batch = batch.astype(object)
+                    cnx.executemany('INSERT OR REPLACE INTO uniprot_db VALUES (?, ?)',
+                                    batch.where(batch.notna(), None).itertuples(index=False, name=None))
+        return cnx
+
+    @staticmethod
+    def lookupUniProt(uniprot_index: sqlite3.Connection, gene_ids) -> pd.DataFrame:
+        """
+        Gene ID -> UniProtKB table of the given genes only, looked up in an index built
+        by indexUniProtDB. Same format as loadUniProtDB, so it can be passed to linkUniProt.
+        """
+        uniprot_index.execute('CREATE TEMP TABLE IF NOT EXISTS lookup ("Gene ID" TEXT PRIMARY KEY) WITHOUT ROWID')
+        uniprot_index.execute('DELETE FROM lookup')
+        uniprot_index.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((x,) for x in gene_ids))
+        uniprot_db = pd.read_sql('SELECT uniprot_db."Gene ID", uniprot_db."UniProtKB" FROM lookup '
+                                 'JOIN uniprot_db ON uniprot_db."Gene ID" = lookup."Gene ID"', uniprot_index)
+        uniprot_index.commit()
+        # NULLs come back as None, loadUniProtDB has NaN for genes without a UniProtKB
+        uniprot_db['UniProtKB'] = uniprot_db['UniProtKB'].astype(object).where(uniprot_db['UniProtKB'].notna(), np.nan)
+        return uniprot_db
+
+    def linkUniProt(self, uniprot_db: pd.DataFrame = None):
         """
-        Matches the UniProt values with the corresponding genes. Matchings lie in the .csv file
-        generated by the gff_parser.
+        Matches the UniProt values with the corresponding genes. Matchings lie in the
+        gff_sequencing table(s) generated by the gff_parser.
+
+        Linking is a single left join of the gene table against the Gene ID -> UniProtKB table,
+        so genes keep their order. Genes that don't appear in the gff table get an empty
+        UniProtKB.
+
+        Args:
+            uniprot_db: pd.DataFrame
+                Gene ID -> UniProtKB table as returned by loadUniProtDB. Loaded from
+                gff_sequencing if not given.
 
         Returns: None
         """
         save_flag = False
         if self.genes is None:
-            self.genes = pd.read_csv(self.parsed_genedata_path + 'genes.csv')
+            self.genes = read_table(self.parsed_genedata_path + 'genes')
             save_flag = True
-        columns, genes_np = self.genes.columns.to_list(), self.genes.to_numpy()
-        pbar = tqdm(total=self.genes.shape[0], unit='matches')
+        if uniprot_db is None:
+            uniprot_db = self.loadUniProtDB()
 
-        uniprot_db = pd.read_csv(self.uniprot_path + '/gff_sequencing.csv').to_numpy()
-        # create a map from gene_id to UniProtKB built from gff sequencing
-        uniprot_db = dict(zip(uniprot_db[:, 0], uniprot_db[:, 2]))
+        # the parseGenes methods leave the table indexed by 'Gene ID'
+        indexed = 'Gene ID' in self.genes.index.names
+        genes = self.genes.reset_index() if indexed else self.genes.reset_index(drop=True)
+        matches = genes[['Gene ID']].merge(uniprot_db, on='Gene ID', how='left',
+                                           validate='many_to_one', indicator=True)
+        genes['UniProtKB'] = np.where(matches['_merge'] == 'both', matches['UniProtKB'].astype(str), '')
+        self.genes = genes.set_index('Gene ID') if indexed else genes
 
-        def uniprot_match(x, progress_bar):
-            element_match = ''
-            try:
-                element_match = uniprot_db[x]
-            except KeyError:
-                pass
-            progress_bar.update(1)
-            return str(element_match)
-        vect_uni_match = np.vectorize(uniprot_match)
-        genes_np[:, 4] = vect_uni_match(genes_np[:, 0], pbar)
-
-        self.genes = pd.DataFrame(data=genes_np, columns=self.genes.columns.to_list())
         if save_flag:
             self.genes.set_index('Gene ID', inplace=True)
-            self.genes.to_csv(self.parsed_genedata_path + 'genes.csv')
+            write_table(self.genes, self.parsed_genedata_path + 'genes', self.formats)
 
     def splitProteins(self):
         """
@@ -179,54 +327,31 @@ class GeneParser:
         Hypotheticals - Genes that do not have a linked UniProt Id
         Recognized - Genes that are assigned a UniProt ID.
 
+        The split is done with a single boolean mask and the number of genes linked to each
+        UniProtKB is counted off the recognized table in the same pass. Saves the
+        hypotheticals and recognized tables and Gene_Ontology/uniprot_freqs.json.
+
         Returns:
             None
         """
-        self.hypothetical = pd.DataFrame(columns=self.genes.columns)
-        self.recognized = pd.DataFrame(columns=self.genes.columns)
-        pbar = tqdm(total=self.genes.shape[0])
-        uniprot_freqs = {}
-
-        for idx, rows in self.genes.iterrows():
-            if pd.isna(rows.loc['UniProtKB']) or rows.loc['UniProtKB'] == (None or 'nan'):
-                self.hypothetical = pd.concat([self.hypothetical, rows], axis=0, ignore_index=True)
-            else:
-                self.recognized = pd.concat([self.recognized, rows], axis=0, ignore_index=True)
-                uniprotKB = rows.loc['UniProtKB']
-                if uniprotKB in uniprot_freqs.keys():
-                    uniprot_freqs[uniprotKB] += 1
-                else:
-                    uniprot_freqs.update({uniprotKB : 1})
-            pbar.update(1)
-
-        pbar.close()
-        self.hypothetical.set_index('Gene ID', inplace=True)
-        self.hypothetical.to_csv(self.parsed_genedata_path + 'hypotheticals.csv')
-        self.recognized.set_index('Gene ID', inplace=True)
-        self.recognized.to_csv(self.parsed_genedata_path + 'recognized.csv')
-
-        with open(self.parent_path + "/Gene_Ontology/uniprot_freqs.json", "w", encoding='utf-8') as file:
-            json.dump(uniprot_freqs, file)
-
-    def generateUniProtFreqs(self):
-        """
-
-        columns = ['Gene ID', 'Organism', 'Gene Family', 'Genome ID', 'UniProtKB', 'Partition']
+        if self.genes is None:
+            self.genes = read_table(self.parsed_genedata_path + 'genes')
+        genes = self.genes.set_index('Gene ID') if 'Gene ID' in self.genes.columns else self.genes
 
-        Returns:
+        # linkUniProt leaves '' for genes missing from the gff table and 'nan' for genes with no UniProtKB
+        uniprots = genes['UniProtKB']
+        hypothetical_mask = uniprots.isna() | uniprots.isin(['', 'nan'])
 
-        """
+        self.hypothetical = genes[hypothetical_mask].assign(UniProtKB=None)
+        self.recognized = genes[~hypothetical_mask]
+        uniprot_freqs = self.recognized.groupby('UniProtKB', sort=False).size().to_dict()
 
-        matrix = self.recognized.to_numpy()
-        uniprots = {}
-        for row in range(matrix.shape[0]):
-            if matrix[row, 4] not in uniprots.keys():
-                uniprots.update({matrix[row, 4]: 1})
-            else:
-                uniprots[matrix[row, 4]] += 1
+        write_table(self.hypothetical, self.parsed_genedata_path + 'hypotheticals', self.formats)
+        write_table(self.recognized, self.parsed_genedata_path + 'recognized', self.formats)
 
-        with open(self.parent_dir + "/Gene_Ontology/uniprot_freqs.json", "w") as file:
-            json.dump(uniprots, file)
+        os.makedirs(self.parent_path + "/Gene_Ontology", exist_ok=True)
+        with open(self.parent_path + "/Gene_Ontology/uniprot_freqs.json", "w", encoding='utf-8') as file:
+            json.dump(uniprot_freqs, file)
 
 
 if __name__ == '__main__':
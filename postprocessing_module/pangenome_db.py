@@ -0,0 +1,209 @@
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+# Every query selects (key, value) rows for the keys bound to {keys}. It is either run for
+# one key ("= ?") or for a chunk of exactly CHUNK_SIZE keys ("IN (?, ..., ?)", short chunks
+# are padded by repeating a key), so each query only ever has two shapes and its prepared
+# statements are reused from sqlite3's per connection statement cache.
+QUERIES = {
+    'genes_of_family': """
+        SELECT "Gene Family", "Gene ID" FROM genes
+        WHERE "Gene Family" {keys} ORDER BY "Gene ID"
+    """,
+    'families_of_organism': """
+        SELECT DISTINCT "Organism", "Gene Family" FROM genes
+        WHERE "Organism" {keys} ORDER BY "Gene Family"
+    """,
+    'family_partition': """
+        SELECT "Gene Family", "Partition" FROM gene_families
+        WHERE "Gene Family" {keys}
+    """,
+    'go_terms_of_family': """
+        SELECT DISTINCT genes."Gene Family", go_processes."Gene Ontology ID"
+        FROM genes JOIN go_processes ON go_processes."UniProtKB" = genes."UniProtKB"
+        WHERE genes."Gene Family" {keys} ORDER BY go_processes."Gene Ontology ID"
+    """,
+    'families_with_go_term': """
+        SELECT DISTINCT go_processes."Gene Ontology ID", genes."Gene Family"
+        FROM go_processes JOIN genes ON genes."UniProtKB" = go_processes."UniProtKB"
+        WHERE go_processes."Gene Ontology ID" {keys} ORDER BY genes."Gene Family"
+    """,
+}
+# queries that have one value per key rather than a list
+SCALAR_QUERIES = ('family_partition',)
+CHUNK_SIZE = 256
+
+
+class PangenomeDB:
+    """
+        Read-only queries on a database built by sqldb_implementation.condense_to_db.
+
+        Every query takes a single id or a list of ids. Lists are looked up in batches
+        of CHUNK_SIZE ids per statement and come back as a dict, id -> result. Results
+        are kept in an LRU cache of cache_size entries (one per query and id), and
+        connections are opened read-only and pooled, so one PangenomeDB can be shared
+        by threads querying at once.
+
+        Attributes:
+        -----------
+        db_path: str
+            path of the database
+        pool_size: int
+            most connections open at once, i.e. most queries running at once
+        cache_size: int
+            most results kept in the cache, 0 to not cache
+        stats: dict
+            'hits', 'misses' and 'queries' (statements run) since the database was opened
+    """
+    def __init__(self, db_path: str, pool_size: int = 4, cache_size: int = 4096):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"No database at {db_path}. Run sqldb_implementation.py first.")
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.stats = {'hits': 0, 'misses': 0, 'queries': 0}
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.pool = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.connections = []
+        self.closed = False
+
+    def connect(self) -> sqlite3.Connection:
+        cnx = sqlite3.connect(f"file:{quote(os.path.abspath(self.db_path))}?mode=ro", uri=True,
+                              check_same_thread=False, cached_statements=4 * len(QUERIES))
+        cnx.execute('PRAGMA query_only = ON')
+        with self.lock:
+            self.connections.append(cnx)
+        return cnx
+
+    def run(self, query: str, keys: list) -> list:
+        """
+            Run a query for at most CHUNK_SIZE keys on a pooled connection.
+        """
+        if len(keys) == 1:
+            sql, params = QUERIES[query].format(keys='= ?'), keys
+        else:
+            sql = QUERIES[query].format(keys=f"IN ({', '.join('?' * CHUNK_SIZE)})")
+            params = keys + [keys[-1]] * (CHUNK_SIZE - len(keys))
+
+        self.slots.acquire()
+        try:
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot query a closed PangenomeDB.")
+            try:
+                cnx = self.pool.get_nowait()
+            except queue.Empty:
+                cnx = self.connect()
+            try:
+                return cnx.execute(sql, params).fetchall()
+            finally:
+                self.pool.put(cnx)
+                with self.lock:
+                    self.stats['queries'] += 1
+        finally:
+            self.slots.release()
+
+    def lookup(self, query: str, ids):
+        """
+            Results of a query for one id, or for a list of ids as a dict id -> result.
+            Lists of values (e.g. the genes of a family) are returned as tuples, shared
+            with the cache. Ids with no rows get () or, for scalar queries, None.
+        """
+        single = isinstance(ids, str)
+        ids = [ids] if single else list(dict.fromkeys(ids))
+
+        results, missing = {}, []
+        with self.lock:
+            for x in ids:
+                if (query, x) in self.cache:
+                    self.cache.move_to_end((query, x))
+                    results[x] = self.cache[(query, x)]
+                else:
+                    missing.append(x)
+            self.stats['hits'] += len(results)
+            self.stats['misses'] += len(missing)
+
+        scalar = query in SCALAR_QUERIES
+        for start in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[start:start + CHUNK_SIZE]
+            found = {x: None if scalar else [] for x in chunk}
+            for key, value in self.run(query, chunk):
+                if scalar:
+                    found[key] = value
+                else:
+                    found[key].append(value)
+            found = {x: value if scalar else tuple(value) for x, value in found.items()}
+            results.update(found)
+
+            if self.cache_size:
+                with self.lock:
+                    for x, value in found.items():
+                        self.cache[(query, x)] = value
+                        self.cache.move_to_end((query, x))
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return results[ids[0]] if single else {x: results[x] for x in ids}
+
+    def genes_of_family(self, families):
+        """
+            Gene IDs of a gene family (or of each of a list of families).
+        """
+        return self.lookup('genes_of_family', families)
+
+    def families_of_organism(self, organisms):
+        """
+            Gene families with at least one gene in an organism (or in each of a list of organisms).
+        """
+        return self.lookup('families_of_organism', organisms)
+
+    def family_partition(self, families):
+        """
+            Partition (persistent, shell, cloud) of a gene family (or of each of a list
+            of families). None for unknown families.
+        """
+        return self.lookup('family_partition', families)
+
+    def go_terms_of_family(self, families):
+        """
+            GO IDs annotating the UniProtKB accessions of the genes of a gene family (or
+            of each of a list of families).
+        """
+        return self.lookup('go_terms_of_family', families)
+
+    def families_with_go_term(self, go_ids):
+        """
+            Gene families with a gene whose UniProtKB accession is annotated with a GO ID
+            (or with each of a list of GO IDs).
+        """
+        return self.lookup('families_with_go_term', go_ids)
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def close(self):
+        """
+            Close every connection. Queries still running finish first.
+        """
+        for _ in range(self.pool_size):
+            self.slots.acquire()
+        self.closed = True
+        with self.lock:
+            for cnx in self.connections:
+                cnx.close()
+            self.connections = []
+        for _ in range(self.pool_size):
+            self.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
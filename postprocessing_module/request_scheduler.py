@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+import pandas as pd
+import requests
+from email.utils import parsedate_to_datetime
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RequestScheduler:
+    """
+        Paces and retries the HTTP requests of one or more UniProtRESTHandlers.
+        Share one scheduler between the handlers of every pipeline running on the
+        host to keep their combined request rate under the limit.
+
+        - A token bucket refilled at rate tokens per second (up to burst tokens) is
+          drawn from before every request.
+        - Requests answered with a status in RETRY_STATUSES, or that fail to connect,
+          are retried up to max_retries times with exponential backoff and jitter. A
+          Retry-After header overrides the backoff and holds back every request that
+          goes through the scheduler, not just the one that got it.
+        - poll_interval grows the wait between job status checks exponentially, so
+          long jobs aren't polled at a fixed rate.
+
+        Attributes:
+        -----------
+        rate: float
+            requests per second. None to not limit the rate
+        burst: int
+            number of requests that can go out back to back after a quiet period
+        max_retries: int
+            retries per request on top of the first attempt
+        backoff: float
+            wait before the first retry, doubled on every retry, in seconds
+        max_backoff: float
+            cap on the retry and polling waits, in seconds
+        stats: dict
+            endpoint -> {'requests', 'retries', 'errors', 'latency', 'max_latency'}.
+            latency is the total seconds spent waiting for responses. See report()
+    """
+    def __init__(self, rate: float = 10.0, burst: int = 10, max_retries: int = 5, backoff: float = 0.5,
+                 max_backoff: float = 60.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {}
+
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def acquire(self):
+        """
+            Block until the token bucket and any Retry-After pause allow a request.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+                    self.refilled_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+            Hold back every request for the next seconds seconds.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @staticmethod
+    def retry_after(response: requests.Response):
+        """
+            Seconds to wait according to the Retry-After header (delay in seconds or
+            HTTP date), None if there is no usable header.
+        """
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+            Exponential backoff with full jitter for the attempt-th retry (0 based).
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def poll_interval(self, initial: float, attempt: int, factor: float = 2.0) -> float:
+        """
+            Wait before the attempt-th (0 based) status check of a job that is still
+            running: initial, then growing by factor, capped at max_backoff.
+        """
+        return min(self.max_backoff, initial * factor ** attempt)
+
+    def record(self, endpoint: str, latency: float = None, retry: bool = False, error: bool = False):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {'requests': 0, 'retries': 0, 'errors': 0,
+                                                     'latency': 0.0, 'max_latency': 0.0})
+            if latency is not None:
+                stats['requests'] += 1
+                stats['latency'] += latency
+                stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['retries'] += retry
+            stats['errors'] += error
+
+    def request(self, session: requests.Session, method: str, url: str, endpoint: str = None,
+                **kwargs) -> requests.Response:
+        """
+            Send a request through the scheduler.
+
+            @params
+                session : requests.Session
+                    the session to send the request with
+                method, url, **kwargs : see requests.Session.request
+                endpoint : str
+                    name the request is counted under in stats. Defaults to the url's path
+
+            @returns
+                requests.Response, the first one that doesn't need retrying or the last
+                one once the retries are exhausted. Raises the connection error of the
+                last attempt if it never got a response.
+        """
+        endpoint = endpoint or requests.utils.urlparse(url).path
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(endpoint, time.monotonic() - start, error=True)
+                if attempt == self.max_retries:
+                    raise
+                self.record(endpoint, retry=True)
+                time.sleep(self.backoff_delay(attempt))
+                continue
+
+            failed = response.status_code in RETRY_STATUSES
+            self.record(endpoint, time.monotonic() - start, error=failed)
+            if not failed or attempt == self.max_retries:
+                return response
+
+            self.record(endpoint, retry=True)
+            delay = self.retry_after(response)
+            if delay is None:
+                time.sleep(self.backoff_delay(attempt))
+            else:
+                # the server asked everyone to slow down, not just this request
+                self.pause(min(delay, self.max_backoff))
+
+    def report(self) -> pd.DataFrame:
+        """
+            stats as a table, one row per endpoint, with the mean latency in seconds.
+        """
+        report = pd.DataFrame.from_dict(self.stats, orient='index')
+        if not report.empty:
+            report['mean_latency'] = report['latency'] / report['requests'].clip(lower=1)
+        return report
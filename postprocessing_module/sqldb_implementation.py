@@ -1,36 +1,320 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 import os
+from table_store import iter_table, table_exists
+from gene_table import GeneTable
 
+# Column names follow the trimmed_matrix_files tables
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS organisms (
+        "Organism" TEXT PRIMARY KEY,
+        "Genome ID" TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS gene_families (
+        "Gene Family" TEXT PRIMARY KEY,
+        "Partition" TEXT
+    );
+    CREATE TABLE IF NOT EXISTS uniprot_proteins (
+        "UniProtKB" TEXT PRIMARY KEY,
+        "Protein Name" TEXT,
+        "EC Numbers" TEXT,
+        "Count" INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS genes (
+        "Gene ID" TEXT PRIMARY KEY,
+        "Gene Family" TEXT NOT NULL REFERENCES gene_families ("Gene Family"),
+        "Organism" TEXT NOT NULL REFERENCES organisms ("Organism"),
+        "UniProtKB" TEXT REFERENCES uniprot_proteins ("UniProtKB")
+    );
+    CREATE TABLE IF NOT EXISTS go_terms (
+        "Gene Ontology ID" TEXT PRIMARY KEY,
+        "Gene Ontology Classification" TEXT,
+        "Classification Value" TEXT
+    );
+    CREATE TABLE IF NOT EXISTS go_processes (
+        "UniProtKB" TEXT NOT NULL REFERENCES uniprot_proteins ("UniProtKB"),
+        "Gene Ontology ID" TEXT NOT NULL REFERENCES go_terms ("Gene Ontology ID"),
+        PRIMARY KEY ("UniProtKB", "Gene Ontology ID")
+    ) WITHOUT ROWID;
+"""
 
-def condense_to_db(dbname: str, path: str, trimmed_matrix: pd.DataFrame, gene_ont: pd.DataFrame):
-    if os.path.exists(f"{path}{dbname}"):
-        os.remove(f"{path}{dbname}")
+# Built after the bulk load, which is faster than keeping them up to date row by row.
+# The primary keys already index gene ids, families, organisms, UniProtKB -> GO and GO terms.
+INDEXES = """
+    CREATE INDEX IF NOT EXISTS genes_gene_family ON genes ("Gene Family");
+    CREATE INDEX IF NOT EXISTS genes_organism_family ON genes ("Organism", "Gene Family");
+    CREATE INDEX IF NOT EXISTS genes_uniprotkb ON genes ("UniProtKB");
+    CREATE INDEX IF NOT EXISTS go_processes_go_id ON go_processes ("Gene Ontology ID");
+"""
 
-    cnx = sqlite3.connect(":memory")
+# The database is built in a scratch file that only replaces the real one once complete,
+# so there is nothing to protect with a journal or fsyncs while loading
+LOAD_PRAGMAS = """
+    PRAGMA journal_mode = OFF;
+    PRAGMA synchronous = OFF;
+    PRAGMA locking_mode = EXCLUSIVE;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -262144;
+    PRAGMA foreign_keys = OFF;
+"""
 
-    genes_table = trimmed_matrix.loc[:, ['Gene ID', 'Gene Family']].set_index('Gene ID')
-    genes_table.to_sql('genes', cnx, if_exists='fail')
+# Rows are upserted and only rewritten when they changed, so loading the tables into an
+# existing database only writes the difference
+UPSERT_ORGANISM = """
+    INSERT INTO organisms VALUES (?, ?) ON CONFLICT ("Organism") DO UPDATE
+    SET "Genome ID" = excluded."Genome ID" WHERE "Genome ID" IS NOT excluded."Genome ID"
+"""
+UPSERT_FAMILY = """
+    INSERT INTO gene_families VALUES (?, ?) ON CONFLICT ("Gene Family") DO UPDATE
+    SET "Partition" = excluded."Partition" WHERE "Partition" IS NOT excluded."Partition"
+"""
+UPSERT_GENE = """
+    INSERT INTO genes VALUES (?, ?, ?, ?) ON CONFLICT ("Gene ID") DO UPDATE
+    SET "Gene Family" = excluded."Gene Family", "Organism" = excluded."Organism", "UniProtKB" = excluded."UniProtKB"
+    WHERE "Gene Family" IS NOT excluded."Gene Family" OR "Organism" IS NOT excluded."Organism"
+        OR "UniProtKB" IS NOT excluded."UniProtKB"
+"""
+UPSERT_PROTEIN_NAME = """
+    INSERT INTO uniprot_proteins ("UniProtKB", "Protein Name") VALUES (?, ?) ON CONFLICT ("UniProtKB") DO UPDATE
+    SET "Protein Name" = excluded."Protein Name" WHERE "Protein Name" IS NOT excluded."Protein Name"
+"""
+UPSERT_PROTEIN = """
+    INSERT INTO uniprot_proteins ("UniProtKB", "Protein Name", "EC Numbers") VALUES (?, ?, ?)
+    ON CONFLICT ("UniProtKB") DO UPDATE SET "Protein Name" = excluded."Protein Name", "EC Numbers" = excluded."EC Numbers"
+    WHERE "Protein Name" IS NOT excluded."Protein Name" OR "EC Numbers" IS NOT excluded."EC Numbers"
+"""
 
-    organism_link = trimmed_matrix.loc[
-        trimmed_matrix['Gene ID'] == trimmed_matrix['Gene Family'], ['Organism', 'Genome ID']]
-    organism_link = organism_link.drop_duplicates(subset=['Organism']).set_index('Organism')
-    organism_link.to_sql('organisms', cnx, if_exists='fail')
+# Records the accessions and families of the genes an incremental update inserts, changes
+# or deletes, so that only their counts and orphaned families are revisited. The tables
+# aren't keyed: the outer upsert's conflict handling would override an OR IGNORE in here
+TRACK_CHANGES = """
+    CREATE TEMP TABLE touched_accessions ("UniProtKB" TEXT);
+    CREATE TEMP TABLE touched_families ("Gene Family" TEXT);
+    CREATE TEMP TRIGGER gene_inserted AFTER INSERT ON main.genes BEGIN
+        INSERT INTO touched_accessions SELECT new."UniProtKB" WHERE new."UniProtKB" IS NOT NULL;
+    END;
+    CREATE TEMP TRIGGER gene_updated AFTER UPDATE ON main.genes BEGIN
+        INSERT INTO touched_accessions SELECT new."UniProtKB" WHERE new."UniProtKB" IS NOT NULL;
+        INSERT INTO touched_accessions SELECT old."UniProtKB" WHERE old."UniProtKB" IS NOT NULL;
+        INSERT INTO touched_families VALUES (old."Gene Family");
+    END;
+    CREATE TEMP TRIGGER gene_deleted AFTER DELETE ON main.genes BEGIN
+        INSERT INTO touched_accessions SELECT old."UniProtKB" WHERE old."UniProtKB" IS NOT NULL;
+        INSERT INTO touched_families VALUES (old."Gene Family");
+    END;
+"""
 
-    gene_families_table = trimmed_matrix.drop_duplicates(subset=['Gene Family']).set_index('Gene Family').loc[:,
-                          ['Annotation', 'Partition', '# Isolates', '# Sequences', 'Avg seqs/isolate', 'UniProtKB']]
-    gene_families_table.to_sql('gene_families', cnx, if_exists='fail')
+COUNT_GENES = """
+    UPDATE uniprot_proteins SET "Count" =
+        (SELECT COUNT(*) FROM genes WHERE genes."UniProtKB" = uniprot_proteins."UniProtKB")
+"""
 
-    go_processes = gene_ont.set_index('Gene Ontology ID').loc[:,
-                   ['Gene Ontology Classification', 'Classification Value', 'UniProtKB']]
-    go_processes.to_sql('go_processes', cnx, if_exists='fail')
+GENE_COLUMNS = ['Gene ID', 'Organism', 'Gene Family', 'Genome ID', 'UniProtKB', 'Partition']
+GO_COLUMNS = ['Gene Ontology ID', 'Protein Name', 'UniProtKB', 'Gene Ontology Classification',
+              'Classification Value']
 
-    uniprots = gene_ont.drop_duplicates(subset=['UniProtKB']).set_index('UniProtKB').loc[:,
-               ['Protein Name', 'Count']]
-    uniprots.to_sql('uniprot_proteins', cnx, if_exists='fail')
 
-    cnx.execute("vacuum main into " + f"\'{path}{dbname}\'")
-    cnx.close()
+def records(df: pd.DataFrame) -> list:
+    """
+        Rows of df as tuples for executemany, with missing values as NULL.
+    """
+    return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def uniprot_ids(values: pd.Series) -> pd.Series:
+    # GeneParser.linkUniProt leaves '' (and older tables 'nan') for genes without a UniProtKB
+    values = values.astype(object)
+    return values.where(values.notna() & ~values.isin(['', 'nan']), None)
+
+
+def load_genes(cnx: sqlite3.Connection, genes_path: str, batch_size: int = 50000,
+               existing: pd.DataFrame = None) -> set:
+    """
+        Stream the gene table into genes, gene_families, organisms and uniprot_proteins.
+        Genes that are already in existing (the genes table indexed by 'Gene ID') as
+        they are in the gene table are skipped. Returns the organisms of the table.
+
+        The representative filter and the organism and gene family de-duplication run
+        on the integer codes of a GeneTable per batch. The batches share vocabularies,
+        so a code means the same thing in all of them and every family is only upserted
+        from the first batch it shows up in.
+    """
+    seen_organisms = set()
+    vocabularies = {}
+    for batch in iter_table(genes_path, columns=GENE_COLUMNS, batch_size=batch_size):
+        batch = batch.astype({column: object for column in GENE_COLUMNS})
+        batch['UniProtKB'] = uniprot_ids(batch['UniProtKB'])
+        known_families = len(vocabularies.get('Gene Family', []))
+        table = GeneTable.from_frame(batch, vocabularies)
+        codes = table.codes
+
+        # the Genome ID of a gene is that of its family's representative, so only
+        # representatives (Gene ID == Gene Family) carry their own organism's genome id.
+        # Gene IDs are prefixed with the genome id, which covers the other organisms.
+        representative = table.code('Gene Family', codes['Gene ID']) == codes['Gene Family'].to_numpy()
+        order = np.argsort(~representative, kind='stable')
+        order = order[~codes['Organism'].iloc[order].duplicated().to_numpy()]
+        organisms = table.take(order).to_frame(['Organism', 'Genome ID', 'Gene ID'])
+        organisms['Genome ID'] = organisms['Genome ID'].astype(object).where(
+            representative[order], organisms['Gene ID'].str.split('_').str[0])
+        cnx.executemany(UPSERT_ORGANISM, records(organisms[['Organism', 'Genome ID']]))
+        seen_organisms.update(organisms['Organism'])
+
+        family_codes = codes['Gene Family']
+        new_families = (family_codes >= known_families) & ~family_codes.duplicated()
+        families = table.take(new_families.to_numpy()).to_frame(['Gene Family', 'Partition'])
+        cnx.executemany(UPSERT_FAMILY, records(families))
+
+        genes = batch[['Gene ID', 'Gene Family', 'Organism', 'UniProtKB']]
+        if existing is not None:
+            current = existing.reindex(genes['Gene ID']).to_numpy()
+            values = genes[existing.columns].to_numpy()
+            genes = genes[~((current == values) | (pd.isna(current) & pd.isna(values))).all(axis=1)]
+
+        accessions = genes['UniProtKB'].dropna().unique()
+        cnx.executemany('INSERT INTO uniprot_proteins ("UniProtKB") VALUES (?) ON CONFLICT DO NOTHING',
+                        ((x,) for x in accessions))
+
+        cnx.executemany(UPSERT_GENE, records(genes))
+    return seen_organisms
+
+
+def load_go(cnx: sqlite3.Connection, go_path: str, proteins_path: str = None, batch_size: int = 50000):
+    """
+        Stream the GO ID store (and the per-accession go_proteins table, if there is
+        one) into go_terms, go_processes and uniprot_proteins.
+    """
+    for batch in iter_table(go_path, columns=GO_COLUMNS, batch_size=batch_size):
+        batch = batch.astype(object)
+        terms = batch[['Gene Ontology ID', 'Gene Ontology Classification', 'Classification Value']] \
+            .drop_duplicates('Gene Ontology ID')
+        cnx.executemany('INSERT INTO go_terms VALUES (?, ?, ?) ON CONFLICT DO NOTHING', records(terms))
+
+        proteins = batch[['UniProtKB', 'Protein Name']].drop_duplicates('UniProtKB')
+        cnx.executemany(UPSERT_PROTEIN_NAME, records(proteins))
+
+        cnx.executemany('INSERT INTO go_processes VALUES (?, ?) ON CONFLICT DO NOTHING',
+                        records(batch[['UniProtKB', 'Gene Ontology ID']]))
+
+    if proteins_path is not None and table_exists(proteins_path):
+        for batch in iter_table(proteins_path, columns=['UniProtKB', 'Protein Name', 'EC Numbers'],
+                                batch_size=batch_size):
+            cnx.executemany(UPSERT_PROTEIN, records(batch.astype(object)))
+
+
+def check_foreign_keys(cnx: sqlite3.Connection):
+    violations = cnx.execute('PRAGMA foreign_key_check').fetchall()
+    if violations:
+        raise ValueError(f"{len(violations)} rows reference missing keys, e.g. (table, rowid, parent, fk) "
+                         f"{violations[:5]}")
+
+
+def update_db(db_path: str, genes_path: str, go_path: str, proteins_path: str = None, batch_size: int = 50000):
+    """
+        Bring an existing pangenome database up to date with the trimmed_matrix_files
+        tables in a single transaction. New and changed genes, families, organisms,
+        UniProt proteins and GO processes are upserted (rows that are already up to
+        date are skipped), the organisms that are no longer in the gene table are
+        deleted with their genes, and so are the families and UniProt proteins left
+        without genes (unless the GO store still has the protein). Counts
+        are only recomputed for the accessions of the genes that changed, so the
+        writes scale with the size of the change rather than that of the database.
+
+        Args: see condense_to_db
+
+        Returns: None
+    """
+    cnx = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        cnx.execute('PRAGMA foreign_keys = ON')
+        # no-ops on databases built by condense_to_db
+        cnx.executescript(SCHEMA)
+        cnx.executescript(INDEXES)
+        cnx.executescript(TRACK_CHANGES)
+
+        cnx.execute('BEGIN IMMEDIATE')
+        try:
+            existing = pd.read_sql('SELECT "Gene ID", "Gene Family", "Organism", "UniProtKB" FROM genes', cnx,
+                                   index_col='Gene ID')
+            seen_organisms = load_genes(cnx, genes_path, batch_size, existing)
+            dropped = [(x,) for (x,) in cnx.execute('SELECT "Organism" FROM organisms') if x not in seen_organisms]
+            cnx.executemany('DELETE FROM genes WHERE "Organism" = ?', dropped)
+            cnx.executemany('DELETE FROM organisms WHERE "Organism" = ?', dropped)
+            cnx.execute('DELETE FROM gene_families WHERE "Gene Family" IN (SELECT "Gene Family" FROM touched_families) '
+                        'AND NOT EXISTS (SELECT 1 FROM genes WHERE genes."Gene Family" = gene_families."Gene Family")')
+            cnx.execute(COUNT_GENES + ' WHERE "UniProtKB" IN (SELECT "UniProtKB" FROM touched_accessions)')
+            # accessions only the deleted genes had. load_go brings back those still in the GO store
+            cnx.execute('DELETE FROM uniprot_proteins WHERE "UniProtKB" IN (SELECT "UniProtKB" FROM touched_accessions) '
+                        'AND "Count" = 0 AND NOT EXISTS (SELECT 1 FROM go_processes '
+                        'WHERE go_processes."UniProtKB" = uniprot_proteins."UniProtKB")')
+
+            load_go(cnx, go_path, proteins_path, batch_size)
+            cnx.execute('COMMIT')
+        except BaseException:
+            cnx.execute('ROLLBACK')
+            raise
+        # refreshes the planner statistics of the tables that changed enough to need it
+        cnx.execute('PRAGMA optimize')
+    finally:
+        cnx.close()
+
+
+def condense_to_db(dbname: str, path: str, genes_path: str = None, go_path: str = None,
+                   proteins_path: str = None, batch_size: int = 50000, incremental: bool = False):
+    """
+        Build the pangenome database <path><dbname> from the trimmed_matrix_files
+        tables. The tables are streamed in batches of batch_size rows and bulk loaded
+        with executemany into a scratch file, with the journal and fsyncs off. The
+        indexes are built once everything is in, the foreign keys are checked, and
+        the scratch file then replaces any existing database.
+
+        With incremental, an existing database is updated in place instead (see update_db).
+
+        Args:
+            dbname: str
+                file name of the database
+            path: str
+                directory of the database, ending in '/'
+            genes_path, go_path, proteins_path: str
+                the genes, go_ids and go_proteins tables (see table_store). Default to
+                <path>genes, <path>go_ids and <path>go_proteins. go_proteins is optional.
+            batch_size: int
+                number of rows per batch
+            incremental: bool
+                update <path><dbname> if it exists rather than rebuilding it
+
+        Returns: None
+    """
+    genes_path = path + 'genes' if genes_path is None else genes_path
+    go_path = path + 'go_ids' if go_path is None else go_path
+    proteins_path = path + 'go_proteins' if proteins_path is None else proteins_path
+    if incremental and os.path.exists(f"{path}{dbname}"):
+        update_db(f"{path}{dbname}", genes_path, go_path, proteins_path, batch_size)
+        return
+
+    scratch_path = f"{path}{dbname}.building"
+    if os.path.exists(scratch_path):
+        os.remove(scratch_path)
+
+    cnx = sqlite3.connect(scratch_path)
+    try:
+        cnx.executescript(LOAD_PRAGMAS)
+        cnx.executescript(SCHEMA)
+        with cnx:
+            load_genes(cnx, genes_path, batch_size)
+            load_go(cnx, go_path, proteins_path, batch_size)
+            cnx.executescript(INDEXES)
+            cnx.execute(COUNT_GENES)
+        check_foreign_keys(cnx)
+        cnx.execute('ANALYZE')
+        cnx.execute('PRAGMA journal_mode = DELETE')
+        cnx.close()
+    except BaseException:
+        cnx.close()
+        os.remove(scratch_path)
+        raise
+    os.replace(scratch_path, f"{path}{dbname}")
 
 
 if __name__ == '__main__':
@@ -39,18 +323,15 @@ if __name__ == '__main__':
 
     parent_dir = parent_dir if parent_dir[-1] == '/' else parent_dir + '/'
     dbname = dbname if ".db" in dbname else dbname + ".db"
-    
-    try:
-        trimmed_matrix = pd.read_csv(parent_dir + 'genes.csv')
-    except FileNotFoundError:
+
+    if not table_exists(parent_dir + 'genes'):
         print("Please run matrix_trimmer.py first.")
         quit()
 
-    try:
-        gene_ont = pd.read_csv(parent_dir + 'go_ids.csv')
-    except FileNotFoundError:
+    if not table_exists(parent_dir + 'go_ids'):
         print("Please run gene_ont_proc.py before running this")
         quit()
 
-    condense_to_db(dbname, parent_dir, trimmed_matrix, gene_ont)
-    
\ No newline at end of file
+    incremental = os.path.exists(parent_dir + dbname) and \
+        input(f"{dbname} already exists. Update it instead of rebuilding it? (y/n): ").strip().lower() == 'y'
+    condense_to_db(dbname, parent_dir, incremental=incremental)
@@ -0,0 +1,157 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columns that repeat a handful of long strings on every row (organism names, gene family
+# names, ...). They are dictionary encoded in the parquet files and come back as
+# pandas categoricals.
+DICTIONARY_COLUMNS = ['Organism', 'Gene Family', 'Genome ID', 'Partition']
+TABLE_FORMATS = ('parquet', 'csv')
+DEFAULT_FORMATS = ('parquet',)
+
+
+class TableWriter:
+    """
+        Writes one of the trimmed_matrix_files tables (genes, gff_sequencing, recognized,
+        hypotheticals, go_ids) to disk, chunk by chunk, in one or more formats.
+
+        Parquet files get the columns in DICTIONARY_COLUMNS dictionary encoded. A named
+        index (e.g. 'Gene ID') is stored as a regular column so that the parquet and csv
+        versions of a table read back identically through read_table. Every chunk after the
+        first is cast to the schema of the first one.
+
+        Attributes:
+        -----------
+        path: str
+            path of the table without the file extension, e.g. <trimmed_matrix_files>/genes
+        formats: tuple[str]
+            any of 'parquet' and 'csv'. Pass both to keep emitting csv files for
+            compatibility with older notebooks.
+    """
+    def __init__(self, path: str, formats: tuple = DEFAULT_FORMATS):
+        unknown_formats = [x for x in formats if x not in TABLE_FORMATS]
+        if unknown_formats or not formats:
+            raise ValueError(f"Unknown table format(s) {unknown_formats}. Pick from {TABLE_FORMATS}")
+        self.path = path
+        self.formats = formats
+        self.schema = None
+        self.parquet_writer = None
+        self.csv_header = True
+
+    def write(self, df: pd.DataFrame):
+        if 'csv' in self.formats:
+            # like the parquet branch, an unnamed (range) index isn't a column of the table
+            df.to_csv(self.path + '.csv', mode='w' if self.csv_header else 'a', header=self.csv_header,
+                      index=any(df.index.names))
+            self.csv_header = False
+
+        if 'parquet' in self.formats:
+            df = df.reset_index() if any(df.index.names) else df.reset_index(drop=True)
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self.parquet_writer is None:
+                self.schema = table.schema
+                self.parquet_writer = pq.ParquetWriter(
+                    self.path + '.parquet', self.schema,
+                    use_dictionary=[x for x in DICTIONARY_COLUMNS if x in df.columns])
+            self.parquet_writer.write_table(table)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_table(df: pd.DataFrame, path: str, formats: tuple = DEFAULT_FORMATS):
+    """
+        Write a whole table in one go. See TableWriter.
+
+        Args:
+            df: pd.DataFrame
+                the table to write
+            path: str
+                path of the table without the file extension
+            formats: tuple[str]
+                any of 'parquet' and 'csv'
+
+        Returns: None
+    """
+    with TableWriter(path, formats) as writer:
+        writer.write(df)
+
+
+def table_file(path: str):
+    """
+        Find the file backing a table. If both <path>.parquet and <path>.csv exist, the
+        most recently written one is used (parquet on a tie), so a table rewritten in
+        just one format never reads back stale from the other. If path already ends in
+        .parquet or .csv it is used as is.
+
+        Returns:
+            str, the path of the file or None if the table doesn't exist
+    """
+    if os.path.splitext(path)[1] in ('.parquet', '.csv'):
+        return path if os.path.exists(path) else None
+    files = [f'{path}.{file_format}' for file_format in TABLE_FORMATS if os.path.exists(f'{path}.{file_format}')]
+    # max keeps the first of equally recent files, and TABLE_FORMATS lists parquet first
+    return max(files, key=lambda x: os.stat(x).st_mtime_ns) if files else None
+
+
+def table_exists(path: str) -> bool:
+    return table_file(path) is not None
+
+
+def read_table(path: str, columns: list = None) -> pd.DataFrame:
+    """
+        Read a table written by write_table (or one of the older csv files).
+
+        Args:
+            path: str
+                path of the table, with or without the file extension
+            columns: list[str]
+                only read these columns. Parquet files skip the other columns on disk.
+
+        Returns:
+            pd.DataFrame. The dictionary encoded columns are returned as categoricals
+            when read from parquet.
+    """
+    file = table_file(path)
+    if file is None:
+        raise FileNotFoundError(f"No parquet or csv table found at {path}")
+
+    if file.endswith('.parquet'):
+        return pd.read_parquet(file, columns=columns, read_dictionary=DICTIONARY_COLUMNS)
+    return pd.read_csv(file, usecols=columns)
+
+
+def iter_table(path: str, columns: list = None, batch_size: int = 100000):
+    """
+        Read a table written by write_table (or one of the older csv files) in batches
+        of rows, without loading all of it.
+
+        Args:
+            path: str
+                path of the table, with or without the file extension
+            columns: list[str]
+                only read these columns
+            batch_size: int
+                maximum number of rows per batch
+
+        Returns:
+            generator of pd.DataFrame
+    """
+    file = table_file(path)
+    if file is None:
+        raise FileNotFoundError(f"No parquet or csv table found at {path}")
+
+    if file.endswith('.parquet'):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file, usecols=columns, chunksize=batch_size)
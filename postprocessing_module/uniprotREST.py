@@ -1,7 +1,11 @@
-import json, requests, re, time, zlib, pandas as pd
-from requests.adapters import HTTPAdapter, Retry
+import io, json, os, queue, requests, re, threading, time, zlib, pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from uniprot_cache import UniProtCache
+from request_scheduler import RequestScheduler
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, parse_qs, urlencode
 from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
 
 class UniProtRESTHandler:
     """
@@ -17,19 +21,30 @@ class UniProtRESTHandler:
 
     """
 
-    def __init__(self, polling_interval: int = 3, num_retries: int = 5):
-        self.POLLING_INTERVAL = polling_interval  # set number of seconds to wait before retrying
-        self.API_URL = "https://rest.uniprot.org"
+    def __init__(self, polling_interval: int = 3, num_retries: int = 5, pool_size: int = 10,
+                 api_url: str = "https://rest.uniprot.org", scheduler: RequestScheduler = None):
+        self.POLLING_INTERVAL = polling_interval  # first wait between status checks, grows while RUNNING
+        self.API_URL = api_url  # point at a FakeUniProtServer's url to run offline
 
-        self.retries = Retry(total=num_retries, backoff_factor=0.25,
-                             status_forcelist=[500, 502, 503, 504])
+        # rate limiting and retries are handled by the scheduler, which can be shared
+        # between handlers to pace all of them together
+        self.scheduler = RequestScheduler(max_retries=num_retries) if scheduler is None else scheduler
+        # pool_size connections are kept alive so that concurrent jobs share the session
         self.session = requests.Session()
-        self.session.mount("https://", HTTPAdapter(max_retries=self.retries))
+        for prefix in ("https://", "http://"):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
 
         self.job_id = None
         self.response = None
         self.headers = None
 
+    def request(self, method: str, url: str, endpoint: str, **kwargs) -> requests.Response:
+        """
+          Send a request on the session, paced and retried by the scheduler.
+          endpoint is the name the request is counted under in the scheduler's stats.
+        """
+        return self.scheduler.request(self.session, method, url, endpoint, **kwargs)
+
     def check_response(self, response: requests.Response):
         """
         Checks the status of the HTTP request and raises it if there's an error.
@@ -66,8 +81,8 @@ class UniProtRESTHandler:
             response : requests.Response
               Object containing the packets received.
         """
-        request = requests.post(
-            f"{self.API_URL}/idmapping/run",
+        request = self.request(
+            "POST", f"{self.API_URL}/idmapping/run", "run",
             data={"from": from_db, "to": to_db, "ids": ",".join(ids)},
         )
         self.check_response(request)
@@ -77,8 +92,9 @@ class UniProtRESTHandler:
     def check_id_mapping_results_ready(self, job_id=None):
         """
           Check if the ID searching job is complete. Sends an HTTP request for the
-          status. Checks if the status RUNNING and tries again in <POLLING_INTERVAL>
-          seconds.
+          status. While the status is NEW or RUNNING it checks again, first after
+          <POLLING_INTERVAL> seconds, then backing off exponentially (see
+          RequestScheduler.poll_interval).
 
           If a failure occurs, it raises an Exception.
 
@@ -93,19 +109,110 @@ class UniProtRESTHandler:
         if job_id is None:
             job_id = self.job_id
 
+        attempt = 0
         while True:
-            request = self.session.get(f"{self.API_URL}/idmapping/status/{job_id}")
+            request = self.request("GET", f"{self.API_URL}/idmapping/status/{job_id}", "status")
             self.check_response(request)
             j = request.json()
             if "jobStatus" in j:
-                if j["jobStatus"] == "RUNNING":
-                    print(f"Retrying in {self.POLLING_INTERVAL}s")
-                    time.sleep(self.POLLING_INTERVAL)
+                if j["jobStatus"] in ("NEW", "RUNNING"):
+                    time.sleep(self.scheduler.poll_interval(self.POLLING_INTERVAL, attempt))
+                    attempt += 1
                 else:
                     raise Exception(j["jobStatus"])
             else:
                 return bool(j["results"] or j["failedIds"])
 
+    def run_id_mapping_job(self, from_db: str, to_db: str, ids: list):
+        """
+          Submit one ID mapping job, wait for it to finish and fetch all of its
+          (json) results. Only uses the job id it submitted, so several jobs can
+          run at once on the same handler.
+
+          @params
+            from_db, to_db, ids : see submit_id_mapping
+
+          @returns
+            results : dict
+              {"results": [...], "failedIds": [...]} of the job
+        """
+        job_id = self.submit_id_mapping(from_db, to_db, ids)
+        if not self.check_id_mapping_results_ready(job_id):
+            return {"results": [], "failedIds": []}
+        link = self.get_id_mapping_results_link(job_id)
+        return self.get_id_mapping_results_search(link)
+
+    def stream_id_mapping(self, from_db: str, to_db: str, ids: list, job_size: int = 5000,
+                          max_workers: int = 4):
+        """
+          Split ids into jobs of at most job_size ids, then submit, poll and
+          fetch up to max_workers of them at a time over the pooled session.
+          Yields each job's results as soon as that job completes, so the
+          order follows job completion, not submission.
+
+          @params
+            from_db, to_db : see submit_id_mapping
+            ids : list[str]
+              all the ids to map
+            job_size : int
+              maximum number of ids per job
+            max_workers : int
+              maximum number of jobs in flight
+
+          @returns
+            generator of (job_index, results) tuples, job_index being the
+            position of the job's ids within ids // job_size
+        """
+        ids = list(ids)
+        jobs = [ids[x:x + job_size] for x in range(0, len(ids), job_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.run_id_mapping_job, from_db, to_db, job): idx
+                       for idx, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def map_ids(self, from_db: str, to_db: str, ids: list, job_size: int = 5000, max_workers: int = 4):
+        """
+          Concurrent, chunked version of submit_id_mapping + check_id_mapping_results_ready +
+          get_id_mapping_results_search. See stream_id_mapping.
+
+          @returns
+            results : dict
+              {"results": [...], "failedIds": [...]} of all the jobs, merged in the
+              order of ids
+        """
+        job_results = dict(self.stream_id_mapping(from_db, to_db, ids, job_size, max_workers))
+        results = {"results": [], "failedIds": []}
+        for idx in sorted(job_results):
+            results = self.combine_batches(results, job_results[idx], "json")
+        return results
+
+    def map_ids_cached(self, from_db: str, to_db: str, ids: list, cache: UniProtCache,
+                       job_size: int = 5000, max_workers: int = 4):
+        """
+          map_ids backed by an on-disk cache. Only the ids that are not in the
+          cache, or whose cached mapping has expired, are submitted to UniProt;
+          the result set is assembled from the cache plus the fresh results.
+          Hit and miss counts are kept on the cache (cache.hits, cache.misses).
+
+          @params
+            from_db, to_db, ids, job_size, max_workers : see map_ids
+            cache : UniProtCache
+              the cache to read from and store fresh results into
+
+          @returns
+            results : dict
+              {"results": [...], "failedIds": [...]}, in the order of ids
+        """
+        ids = list(dict.fromkeys(ids))
+        mapped, missing = cache.get(from_db, to_db, ids)
+        if missing:
+            fresh = self.map_ids(from_db, to_db, missing, job_size, max_workers)
+            mapped.update(cache.put(from_db, to_db, missing, fresh))
+
+        return {"results": [entry for x in ids for entry in mapped[x][0]],
+                "failedIds": [x for x in ids if mapped[x][1]]}
+
     def get_next_link(self, headers):
         """
           Used in pagination, when a file is too big to receive, it's done in batches.
@@ -125,7 +232,69 @@ class UniProtRESTHandler:
             if match:
                 return match.group(1)
 
-    def get_batch(self, batch_response, file_format, compressed):
+    def fetch_pages(self, url, prefetch: int = 0):
+        """
+          Fetches a page and every page after it, following the next links.
+
+          With prefetch > 0 the pages are fetched by a background thread that
+          runs up to prefetch pages ahead of the consumer, so that page N+1 is
+          on the wire while page N is being decompressed and decoded. Errors
+          raised while fetching are re-raised in the consumer.
+
+          @params
+            url : str
+              link to the first page to fetch
+            prefetch : int
+              maximum number of pages fetched ahead. 0 fetches each page only
+              once the previous one has been consumed
+
+          @returns
+            generator of requests.Response, one per page
+        """
+        if prefetch <= 0:
+            while url:
+                response = self.request("GET", url, "results")
+                response.raise_for_status()
+                yield response
+                url = self.get_next_link(response.headers)
+            return
+
+        pages = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if the consumer went away, rather than blocking forever
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def fetch(next_url):
+            try:
+                while next_url and not stop.is_set():
+                    response = self.request("GET", next_url, "results")
+                    response.raise_for_status()
+                    next_url = self.get_next_link(response.headers)
+                    put(response)
+            except Exception as e:
+                put(e)
+            put(None)
+
+        threading.Thread(target=fetch, args=(url,), daemon=True).start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+
+    def get_batch(self, batch_response, file_format, compressed, prefetch: int = 0):
         """
           Large files are batched. Check pagination on uniprot.org.
           Gets the next batch data. Keeps yielding stuff till
@@ -138,6 +307,8 @@ class UniProtRESTHandler:
               The format in which the batch response is
             compressed : bool
               True if batch is compressed. False if it is not
+            prefetch : int
+              number of batches to fetch ahead in the background, see fetch_pages
 
           @returns
             decoded_results : dict
@@ -145,11 +316,8 @@ class UniProtRESTHandler:
 
         """
         batch_url = self.get_next_link(batch_response.headers)
-        while batch_url:
-            batch_response = self.session.get(batch_url)
-            batch_response.raise_for_status()
+        for batch_response in self.fetch_pages(batch_url, prefetch):
             yield self.decode_results(batch_response, file_format, compressed)
-            batch_url = self.get_next_link(batch_response.headers)
 
     def combine_batches(self, all_results, batch_results, file_format):
         """
@@ -176,7 +344,7 @@ class UniProtRESTHandler:
         if job_id is None:
             job_id = self.job_id
         url = f"{self.API_URL}/idmapping/details/{job_id}"
-        request = self.session.get(url)
+        request = self.request("GET", url, "details")
         self.check_response(request)
         return request.json()["redirectURL"]
 
@@ -208,20 +376,125 @@ class UniProtRESTHandler:
         m = re.match(r"\{(.*)\}", element.tag)
         return m.groups()[0] if m else ""
 
+    def iter_xml_page(self, page, chunk_size: int = 1 << 16):
+        """
+          Incrementally parses one page of XML results. The tree of the page is never
+          built: every child of the root element is serialized and dropped as soon as
+          its end tag has been read.
+
+          @params
+            page : str or bytes
+              one page of XML results
+            chunk_size : int
+              number of bytes fed to the parser at a time
+
+          @returns
+            generator of (kind, bytes), kind being one of
+              "header" : the xml declaration and the root start tag
+              "entry"  : one <entry> element
+              "footer" : any other child of the root (e.g. <copyright>), then the
+                         root end tag
+        """
+        if isinstance(page, str):
+            page = page.encode("utf-8")
+        parser = ElementTree.XMLPullParser(events=("start-ns", "start", "end"))
+        prefixes = {}
+        root = None
+        depth = 0
+
+        def qualify(name):
+            namespace, _, local = name[1:].rpartition("}") if name.startswith("{") else ("", "", name)
+            prefix = prefixes.get(namespace, "")
+            return f"{prefix}:{local}" if prefix else local
+
+        # every chunk is fed, then the parser is always closed, which raises a ParseError
+        # if the page was cut short or is malformed
+        for x in [*range(0, len(page), chunk_size), None]:
+            if x is None:
+                parser.close()
+            else:
+                parser.feed(page[x:x + chunk_size])
+            for event, item in parser.read_events():
+                if event == "start-ns":
+                    if root is None:
+                        prefixes.setdefault(item[1], item[0])
+                elif event == "start":
+                    depth += 1
+                    if root is None:
+                        root = item
+                        declarations = "".join(f" xmlns:{prefix}={quoteattr(uri)}" if prefix
+                                               else f" xmlns={quoteattr(uri)}"
+                                               for uri, prefix in prefixes.items())
+                        attributes = "".join(f" {qualify(key)}={quoteattr(value)}"
+                                             for key, value in root.attrib.items())
+                        yield "header", (f"<?xml version='1.0' encoding='utf-8'?>\n"
+                                         f"<{qualify(root.tag)}{declarations}{attributes}>\n").encode("utf-8")
+                elif event == "end":
+                    depth -= 1
+                    if depth == 0:
+                        yield "footer", f"</{qualify(root.tag)}>\n".encode("utf-8")
+                    elif depth == 1:
+                        # elements in the root's default namespace are written unqualified,
+                        # so they don't each repeat the xmlns declaration
+                        for element in item.iter():
+                            if isinstance(element.tag, str) and element.tag.startswith("{") \
+                                    and prefixes.get(element.tag[1:].partition("}")[0]) == "":
+                                element.tag = element.tag.partition("}")[2]
+                        item.tail = "\n"
+                        root.remove(item)
+                        yield "entry" if item.tag == "entry" else "footer", \
+                            ElementTree.tostring(item, encoding="utf-8")
+
+    def write_xml_results(self, xml_results, out_file):
+        """
+          Merges pages of XML results straight into a file: the header of the first
+          page, the entries of every page in order, then the footer of the first page.
+          Only one entry is held in memory at a time, besides the page being read.
+
+          @params
+            xml_results : iterable of str or bytes
+              the pages
+            out_file : binary file object
+
+          @returns
+            n_entries : int
+              number of entries written
+        """
+        n_entries = 0
+        footer = None
+        for i, page in enumerate(xml_results):
+            page_footer = []
+            for kind, data in self.iter_xml_page(page):
+                if kind == "entry":
+                    out_file.write(data)
+                    n_entries += 1
+                elif kind == "header":
+                    if i == 0:
+                        out_file.write(data)
+                else:
+                    page_footer.append(data)
+            if footer is None:
+                footer = page_footer
+        out_file.write(b"".join(footer or []))
+        return n_entries
+
     def merge_xml_results(self, xml_results):
-        merged_root = ElementTree.fromstring(xml_results[0])
-        for result in xml_results[1:]:
-            root = ElementTree.fromstring(result)
-            for child in root.findall("{http://uniprot.org/uniprot}entry"):
-                merged_root.insert(-1, child)
-        ElementTree.register_namespace("", self.get_xml_namespace(merged_root[0]))
-        return ElementTree.tostring(merged_root, encoding="utf-8", xml_declaration=True)
+        merged = io.BytesIO()
+        self.write_xml_results(xml_results, merged)
+        return merged.getvalue()
 
     def print_progress_batches(self, batch_index, size, total):
         n_fetched = min((batch_index + 1) * size, total)
         print(f"Fetched: {n_fetched} / {total}")
 
-    def get_id_mapping_results_search(self, url):
+    def parse_results_url(self, url):
+        """
+          Reads the format, page size and compression of a results URL, adding the
+          default page size (500) to the URL if it doesn't have one.
+
+          @returns
+            url, file_format, size, compressed
+        """
         parsed = urlparse(url)
         query = parse_qs(parsed.query)
         file_format = query["format"][0] if "format" in query else "json"
@@ -234,23 +507,102 @@ class UniProtRESTHandler:
             query["compressed"][0].lower() == "true" if "compressed" in query else False
         )
         parsed = parsed._replace(query=urlencode(query, doseq=True))
-        url = parsed.geturl()
-        request = self.session.get(url)
+        return parsed.geturl(), file_format, size, compressed
+
+    def get_id_mapping_results_search(self, url, prefetch: int = 0):
+        url, file_format, size, compressed = self.parse_results_url(url)
+        request = self.request("GET", url, "results")
         self.check_response(request)
         results = self.decode_results(request, file_format, compressed)
         total = int(request.headers["x-total-results"])
         self.print_progress_batches(0, size, total)
-        for i, batch in enumerate(self.get_batch(request, file_format, compressed), 1):
+        for i, batch in enumerate(self.get_batch(request, file_format, compressed, prefetch), 1):
             results = self.combine_batches(results, batch, file_format)
             self.print_progress_batches(i, size, total)
         if file_format == "xml":
             return self.merge_xml_results(results)
         return results
 
+    def download_id_mapping_results(self, url, out_path, prefetch: int = 0):
+        """
+          Streaming, resumable version of get_id_mapping_results_search. Each page is
+          decoded and appended to out_path as soon as it arrives, so memory use doesn't
+          grow with the number of results:
+            json : one line per page (JSON Lines), each line a {"results": [...], ...} object
+            tsv  : the rows of every page, with the header line written once
+            xml  : a single document, merged as in write_xml_results
+
+          After every page, the next-link cursor and the size of out_path are saved to
+          <out_path>.cursor. Calling this again with the same url after an interruption
+          drops anything written after the last completed page and carries on from the
+          cursor. Once every page is in (and for xml, the footer written), the cursor
+          is marked done and further calls return straight away.
+
+          @params
+            url : str
+              results URL, as returned by get_id_mapping_results_link
+            out_path : str
+              file to write the results to
+            prefetch : int
+              number of pages to fetch ahead in the background, see fetch_pages
+
+          @returns
+            cursor : dict
+              {"url", "next", "offset", "pages", "total", "done"}, plus "footer" for xml
+        """
+        url, file_format, size, compressed = self.parse_results_url(url)
+        if file_format not in ("json", "tsv", "xml"):
+            raise ValueError(f"Streaming downloads support json, tsv and xml, not {file_format}")
+        cursor_path = out_path + ".cursor"
+
+        cursor = None
+        if os.path.exists(cursor_path) and os.path.exists(out_path):
+            with open(cursor_path, "r", encoding="utf-8") as cursor_file:
+                cursor = json.load(cursor_file)
+            if cursor["url"] != url:
+                cursor = None
+        if cursor is not None and cursor["done"]:
+            return cursor
+        if cursor is None:
+            cursor = {"url": url, "next": url, "offset": 0, "pages": 0, "total": None, "done": False}
+
+        with open(out_path, "r+b" if cursor["offset"] else "wb") as out_file:
+            out_file.truncate(cursor["offset"])
+            out_file.seek(cursor["offset"])
+            for request in self.fetch_pages(cursor["next"], prefetch):
+                page = self.decode_results(request, file_format, compressed)
+                next_url = self.get_next_link(request.headers)
+                if file_format == "json":
+                    out_file.write((json.dumps(page) + "\n").encode("utf-8"))
+                elif file_format == "tsv":
+                    lines = page if cursor["pages"] == 0 else page[1:]
+                    out_file.write("".join(line + "\n" for line in lines).encode("utf-8"))
+                else:
+                    # the footer of the first page closes the document once the last page is in
+                    footer = []
+                    for kind, data in self.iter_xml_page(page[0]):
+                        if kind == "entry" or (kind == "header" and cursor["pages"] == 0):
+                            out_file.write(data)
+                        elif kind == "footer":
+                            footer.append(data.decode("utf-8"))
+                    cursor.setdefault("footer", "".join(footer))
+                    if next_url is None:
+                        out_file.write(cursor["footer"].encode("utf-8"))
+                out_file.flush()
+
+                cursor.update(next=next_url, offset=out_file.tell(),
+                              pages=cursor["pages"] + 1, total=int(request.headers["x-total-results"]))
+                cursor["done"] = cursor["next"] is None
+                with open(cursor_path + ".tmp", "w", encoding="utf-8") as cursor_file:
+                    json.dump(cursor, cursor_file)
+                os.replace(cursor_path + ".tmp", cursor_path)
+                self.print_progress_batches(cursor["pages"] - 1, size, cursor["total"])
+        return cursor
+
     def get_id_mapping_results_stream(self, url):
         if "/stream/" not in url:
             url = url.replace("/results/", "/results/stream/")
-        request = self.session.get(url)
+        request = self.request("GET", url, "stream")
         self.check_response(request)
         parsed = urlparse(url)
         query = parse_qs(parsed.query)
@@ -266,12 +618,12 @@ if __name__ == "__main__":
         uniprots = json.load(file)
 
     result_handler = UniProtRESTHandler(polling_interval=30, num_retries=30)
-    result_handler.submit_id_mapping(from_db="UniProtKB_AC-ID", to_db="UniProtKB",
-                                     ids=uniprots.keys())
-
-    if result_handler.check_id_mapping_results_ready():
-        link = result_handler.get_id_mapping_results_link()
-        results = result_handler.get_id_mapping_results_search(link)
+    cache = UniProtCache("../geobacillus_pangenome_thirtygenomes/Gene_Ontology/uniprot_cache.sqlite")
+    results = result_handler.map_ids_cached(from_db="UniProtKB_AC-ID", to_db="UniProtKB",
+                                            ids=list(uniprots.keys()), cache=cache)
+    print(f"UniProt cache: {cache.hits} hits, {cache.misses} misses")
+    print(result_handler.scheduler.report())
+    cache.close()
 
     try:
         print(f"{len(results['results'])} results were found. {len(results['failedIds'])} failed")
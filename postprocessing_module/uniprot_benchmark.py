@@ -0,0 +1,105 @@
+import argparse
+import contextlib
+import io
+import itertools
+import time
+import pandas as pd
+from request_scheduler import RequestScheduler
+from uniprot_fake_server import FakeUniProtServer
+from uniprotREST import UniProtRESTHandler
+
+
+def benchmark(n_ids: int, job_size: int, max_workers: int, server_options: dict,
+              polling_interval: float = 0.1, scheduler_options: dict = None) -> dict:
+    """
+        Map n_ids synthetic accessions with UniProtRESTHandler.map_ids against a fresh
+        FakeUniProtServer and time it end to end (submit, poll, fetch every page).
+
+        Args:
+            n_ids: int
+                number of accessions to map
+            job_size, max_workers: int
+                see UniProtRESTHandler.map_ids
+            server_options: dict
+                keyword arguments of FakeUniProtServer (latency, page_size, error_rate, ...)
+            polling_interval: float
+                see UniProtRESTHandler
+            scheduler_options: dict
+                keyword arguments of RequestScheduler (rate, burst, max_retries, backoff, ...)
+
+        Returns:
+            dict with the timings, the number of requests and retries, the number of
+            injected 5xx errors, and the request count and mean latency per endpoint as
+            seen by the client's RequestScheduler
+    """
+    ids = [f"B{x:07d}" for x in range(n_ids)]
+    with FakeUniProtServer(**server_options) as server:
+        handler = UniProtRESTHandler(polling_interval=polling_interval, pool_size=max(max_workers, 10),
+                                     api_url=server.url, scheduler=RequestScheduler(**(scheduler_options or {})))
+        error = None
+        start = time.perf_counter()
+        # the handler reports its progress on stdout after every page it fetches
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                results = handler.map_ids("UniProtKB_AC-ID", "UniProtKB", ids, job_size=job_size,
+                                          max_workers=max_workers)
+            except Exception as e:
+                results, error = {"results": [], "failedIds": []}, repr(e)
+        seconds = time.perf_counter() - start
+        handler.session.close()
+
+        expected = sum(server.maps(x) for x in ids)
+        report = handler.scheduler.report()
+        row = {'job_size': job_size, 'max_workers': max_workers, 'seconds': round(seconds, 3),
+               'ids_per_s': round(n_ids / seconds, 1),
+               'requests': int(report['requests'].sum()),
+               'retries': int(report['retries'].sum()),
+               'injected_errors': server.stats['errors'],
+               'complete': error is None and len(results['results']) == expected
+                           and len(results['results']) + len(results['failedIds']) == n_ids,
+               'error': error}
+        for endpoint, stats in report.sort_index().iterrows():
+            row[f'{endpoint}_requests'] = int(stats['requests'])
+            row[f'{endpoint}_latency'] = round(stats['mean_latency'], 4)
+        return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark UniProtRESTHandler.map_ids against a local FakeUniProtServer")
+    parser.add_argument('--ids', type=int, default=20000, help="number of accessions to map")
+    parser.add_argument('--job-sizes', type=int, nargs='+', default=[1000, 5000], help="ids per job")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help="jobs in flight")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--job-duration', type=float, default=0.5, help="seconds a job stays RUNNING")
+    parser.add_argument('--page-size', type=int, default=500, help="maximum results per page")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 5xx")
+    parser.add_argument('--retry-after', type=int, default=None,
+                        help="send injected errors as 503s with this Retry-After header")
+    parser.add_argument('--fail-rate', type=float, default=0.05, help="share of accessions that don't map")
+    parser.add_argument('--polling-interval', type=float, default=0.1)
+    parser.add_argument('--retries', type=int, default=5, help="retries per request")
+    parser.add_argument('--rate', type=float, default=10.0, help="client requests per second")
+    parser.add_argument('--burst', type=int, default=10, help="client token bucket size")
+    parser.add_argument('--backoff', type=float, default=0.5, help="seconds before the first retry")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per configuration")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help="also write the results to this csv file")
+    args = parser.parse_args()
+
+    server_options = {'latency': args.latency, 'job_duration': args.job_duration, 'page_size': args.page_size,
+                      'error_rate': args.error_rate, 'retry_after': args.retry_after,
+                      'fail_rate': args.fail_rate, 'seed': args.seed}
+    scheduler_options = {'rate': args.rate, 'burst': args.burst, 'max_retries': args.retries,
+                         'backoff': args.backoff}
+    rows = []
+    for job_size, max_workers, _ in itertools.product(args.job_sizes, args.workers, range(args.repeat)):
+        rows.append(benchmark(args.ids, job_size, max_workers, server_options,
+                              args.polling_interval, scheduler_options))
+        print(f"job_size={job_size} max_workers={max_workers}: {rows[-1]['seconds']}s, "
+              f"{rows[-1]['ids_per_s']} ids/s, {rows[-1]['retries']} retries")
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    if args.out:
+        report.to_csv(args.out, index=False)
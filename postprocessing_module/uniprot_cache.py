@@ -0,0 +1,112 @@
+import json
+import sqlite3
+import time
+
+
+class UniProtCache:
+    """
+        Persistent on-disk cache of UniProt ID mapping results, one row per
+        (from_db, to_db, accession), backed by SQLite.
+
+        A row holds the raw result entries of the accession (UniProt can map one
+        accession to several entries) or records that it failed to map. Rows older
+        than ttl seconds are treated as missing and get re-fetched.
+
+        Attributes:
+        -----------
+        path: str
+            path to the sqlite file
+        ttl: float
+            number of seconds a cached mapping stays valid. Defaults to a week
+        hits, misses: int
+            number of accessions found in / missing from the cache so far
+    """
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.cnx = sqlite3.connect(path)
+        self.cnx.execute("""
+            CREATE TABLE IF NOT EXISTS id_mappings (
+                from_db TEXT NOT NULL,
+                to_db TEXT NOT NULL,
+                accession TEXT NOT NULL,
+                results TEXT NOT NULL,
+                failed INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (from_db, to_db, accession)
+            )""")
+        self.cnx.commit()
+
+    def get(self, from_db: str, to_db: str, ids: list):
+        """
+            Look ids up in the cache.
+
+            @params
+                from_db, to_db : str
+                    the databases of the mapping
+                ids : list[str]
+                    accessions to look up
+
+            @returns
+                cached : dict
+                    accession -> (list of result entries, failed) for the ids with a
+                    valid cache row
+                missing : list[str]
+                    ids that are not cached or whose row has expired, in the order of ids
+        """
+        cached = {}
+        oldest = time.time() - self.ttl
+        ids = list(ids)
+        # stay under sqlite's limit on the number of host parameters
+        for x in range(0, len(ids), 500):
+            batch = ids[x:x + 500]
+            rows = self.cnx.execute(
+                f"SELECT accession, results, failed FROM id_mappings WHERE from_db = ? AND to_db = ? "
+                f"AND fetched_at >= ? AND accession IN ({','.join('?' * len(batch))})",
+                [from_db, to_db, oldest] + batch)
+            for accession, results, failed in rows:
+                cached[accession] = (json.loads(results), bool(failed))
+
+        missing = [x for x in ids if x not in cached]
+        self.hits += len(ids) - len(missing)
+        self.misses += len(missing)
+        return cached, missing
+
+    def put(self, from_db: str, to_db: str, ids: list, results: dict) -> dict:
+        """
+            Store the results of a mapping job for the ids that were submitted.
+
+            @params
+                ids : list[str]
+                    the accessions that were submitted
+                results : dict
+                    {"results": [...], "failedIds": [...]} as returned by UniProtRESTHandler
+
+            @returns
+                dict of accession -> (list of result entries, failed), as returned by get
+        """
+        mapped = {x: ([], False) for x in ids}
+        for entry in results.get("results", []):
+            mapped.setdefault(entry["from"], ([], False))[0].append(entry)
+        for accession in results.get("failedIds", []):
+            mapped[accession] = ([], True)
+
+        fetched_at = time.time()
+        self.cnx.executemany(
+            "INSERT OR REPLACE INTO id_mappings VALUES (?, ?, ?, ?, ?, ?)",
+            ((from_db, to_db, accession, json.dumps(entries), int(failed), fetched_at)
+             for accession, (entries, failed) in mapped.items()))
+        self.cnx.commit()
+        return mapped
+
+    def purge(self):
+        """
+            Delete the expired rows.
+        """
+        self.cnx.execute("DELETE FROM id_mappings WHERE fetched_at < ?", (time.time() - self.ttl,))
+        self.cnx.commit()
+
+    def close(self):
+        self.cnx.close()
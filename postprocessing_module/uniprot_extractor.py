@@ -1,4 +1,110 @@
-import os, gffutils, pandas as pd, json
+import os, argparse, hashlib, json, pandas as pd
+import multiprocess as mp
+from urllib.parse import unquote
+from table_store import write_table, read_table, TABLE_FORMATS, DEFAULT_FORMATS
+
+GFF_COLUMNS = ['Gene ID', 'Gene Symbol', 'UniProtKB', 'Annotation', 'Organism']
+
+
+def parseAttributes(attribute_str: str) -> dict:
+    """
+      Parses the 9th (attributes) column of a GFF3 line into the same
+      dictionary gffutils builds for it: every value is a list of strings,
+      split on commas and then URL-decoded (Prokka writes commas inside
+      values as %2C).
+
+      @params
+          attribute_str: str
+              e.g. 'ID=X_00001;Name=abc;inference=ab initio prediction,similar to...'
+
+      @returns
+          attributes: dict[str, list[str]]
+    """
+    attributes = {}
+    for pair in attribute_str.strip().strip(';').split(';'):
+        if not pair:
+            continue
+        key, _, val = pair.partition('=')
+        values = attributes.setdefault(key.strip(), [])
+        if val:
+            # a comma followed by a space is part of the value, not a separator
+            values.extend(unquote(x) for x in ([val] if ', ' in val else val.split(',')))
+    return attributes
+
+
+def extractRecord(attributes: dict, organism: str):
+    """
+      Cherry picks the gff_sequencing fields out of an attributes dictionary.
+
+      @params
+          attributes: dict
+              Dictionary corresponding to the attributes of a row of the
+              .gff file, as returned by parseAttributes
+          organism: str
+              The organism from which the gene came from
+
+      @returns
+          [ID, Name, UniProtKB, product, organism] or None if the feature
+          has no ID
+    """
+    if 'ID' not in attributes.keys():
+        return None
+
+    UniProtKB = None
+    # split the string by :, the last element contains the UniProtKB
+    for substring in attributes.get('inference', []):
+        if 'UniProtKB' in substring:
+            UniProtKB = substring.split(':')[-1]
+            break
+
+    ID = attributes['ID'][0]
+    Name = attributes['Name'][0] if attributes.get('Name') else None
+    product = attributes['product'][0] if attributes.get('product') else None
+    return [ID, Name, UniProtKB, product, organism]
+
+
+def readGFF(path: str, organism: str = None, batch_size: int = 10000):
+    """
+      Streams a (Prokka) GFF3 file line by line and yields its records in
+      batches, without building a gffutils database. Stops at the ##FASTA
+      section. Features without an ID (e.g. repeat_region) are skipped.
+
+      @params
+          path: str
+              path to the .gff file
+          organism: str
+              The organism the file belongs to. Defaults to the file name
+              without its extension.
+          batch_size: int
+              maximum number of records per yielded batch
+
+      @returns
+          generator of lists of [ID, Name, UniProtKB, product, organism]
+          records, in file order
+    """
+    if organism is None:
+        organism = os.path.basename(path).split('.')[0]
+
+    batch = []
+    with open(path, 'r', encoding='utf-8') as gff_file:
+        for line in gff_file:
+            if line.startswith('##FASTA'):
+                break
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9:
+                continue
+            record = extractRecord(parseAttributes(fields[8]), organism)
+            if record is None:
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
 
 def updateDatabase(db: pd.DataFrame, attributes: dict, organism: str) -> bool:
     """
@@ -29,66 +135,187 @@ def updateDatabase(db: pd.DataFrame, attributes: dict, organism: str) -> bool:
           False: if it fails the checks
 
     """
-    col_keys = ['ID', 'Name', 'inference', 'product']
+    record = extractRecord(attributes, organism)
+    if record is None:
+        return False
+    db.loc[len(db.index)] = record
+    return True
 
-    if 'ID' in attributes.keys():
-        ID, Name, UniProtKB, product = None, None, None, None
 
-        # split the string by :, the last element contains the UniProtKB
-        for substring in attributes['inference']:
-            if 'UniProtKB' in substring:
-                UniProtKB = substring.split(':')[-1]
-                break
+def parseGFFFile(path: str) -> pd.DataFrame:
+    """
+      Reads every record of one .gff file into a DataFrame with the
+      gff_sequencing columns. This is the unit of work of a
+      gff_sequencing worker process.
 
-        try:
-            ID = attributes['ID'][0]
-        except KeyError:
-            ID = attributes['locus-tag']
+      @params
+          path: str
+              path to the .gff file. The organism is the file name without
+              its extension
 
-        try:
-            Name = attributes['Name'][0]
-        except KeyError:
-            pass
+      @returns
+          pd.DataFrame with columns GFF_COLUMNS
+    """
+    records = [record for batch in readGFF(path) for record in batch]
+    return pd.DataFrame(records, columns=GFF_COLUMNS)
+
+
+class GFFCache:
+    """
+      Persistent per-file cache of the records extracted from each .gff file,
+      so that re-runs only re-parse GFFs that are new or have changed.
 
+      Each file is fingerprinted by its path, size, mtime and the SHA-256 of
+      its content. If the size and mtime match the cached entry the file is
+      taken as unchanged without hashing it. Otherwise it is hashed and only
+      re-parsed if the hash differs as well. The records of each file are kept
+      as a parquet table in the cache directory, next to an index.json holding
+      the fingerprints.
+
+      Attributes:
+      -----------
+      cache_dir: str
+          directory holding index.json and the cached tables
+      index: dict
+          .gff file name -> {'path', 'size', 'mtime', 'sha256', 'genes'}
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir if cache_dir[-1] == "/" else cache_dir + "/"
+        os.makedirs(self.cache_dir, exist_ok=True)
         try:
-            product = attributes['product'][0]
-        except KeyError:
-            pass
+            with open(self.cache_dir + "index.json", "r", encoding='utf-8') as file:
+                self.index = json.load(file)
+        except FileNotFoundError:
+            self.index = {}
 
-        db.loc[len(db.index)] = [ID, Name, UniProtKB, product, organism]
-        return True
-    else:
-        return False
+    @staticmethod
+    def hashFile(path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
 
+    def tablePath(self, file: str) -> str:
+        return self.cache_dir + file.rsplit('.', 1)[0]
 
-if __name__ == "__main__":
-    parent_path = input("Enter the parent directory")
-    parent_path = parent_path if "/" in parent_path[-1] else parent_path + "/"
+    def stale(self, gff_path: str, gff_file_list: list) -> dict:
+        """
+          Finds the files that need to be (re-)parsed. Files whose content is
+          unchanged but whose mtime moved get their fingerprint refreshed.
+
+          @returns
+              dict of .gff file name -> new fingerprint, for new or changed files
+        """
+        stale_files = {}
+        for file in gff_file_list:
+            stat = os.stat(gff_path + file)
+            fingerprint = {'path': os.path.abspath(gff_path + file), 'size': stat.st_size,
+                           'mtime': stat.st_mtime_ns}
+            entry = self.index.get(file)
+            if entry is not None and all(entry[key] == fingerprint[key] for key in fingerprint):
+                continue
+
+            fingerprint['sha256'] = self.hashFile(gff_path + file)
+            if entry is not None and entry['sha256'] == fingerprint['sha256']:
+                entry.update(fingerprint)
+            else:
+                stale_files[file] = fingerprint
+        return stale_files
+
+    def update(self, file: str, fingerprint: dict, table: pd.DataFrame):
+        write_table(table, self.tablePath(file), ('parquet',))
+        self.index[file] = dict(fingerprint, genes=table.shape[0])
+
+    def evict(self, gff_file_list: list):
+        """
+          Drops the entries (and tables) of files that are no longer in the GFF directory.
+        """
+        for file in set(self.index) - set(gff_file_list):
+            if os.path.exists(self.tablePath(file) + '.parquet'):
+                os.remove(self.tablePath(file) + '.parquet')
+            del self.index[file]
+
+    def save(self):
+        with open(self.cache_dir + "index.json", "w", encoding='utf-8') as file:
+            json.dump(self.index, file)
+
+    def load(self, gff_file_list: list) -> pd.DataFrame:
+        """
+          Concatenates the cached tables of the given files, in order.
+        """
+        tables = [read_table(self.tablePath(file)) for file in gff_file_list]
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=GFF_COLUMNS)
+
+
+def buildGFFSequencing(parent_path: str, workers: int = None, formats: tuple = DEFAULT_FORMATS,
+                       rebuild: bool = False):
+    """
+      Builds trimmed_matrix_files/gff_sequencing out of every .gff file in
+      <parent_path>/ppan_dataset/GFF/. Only files that are new or changed
+      since the last run are parsed (see GFFCache, kept in
+      trimmed_matrix_files/gff_cache/). They are parsed in a pool of worker
+      processes, one file per task, and each worker returns its own table.
+      gff_sequencing is then rebuilt from the cache in one concat, in file
+      name order. The number of genes per file is saved as gene_count.json
+      in the parent directory.
+
+      @params
+          parent_path: str
+              the pangenome's parent directory
+          workers: int
+              number of worker processes. Defaults to mp.cpu_count()
+          formats: tuple[str]
+              formats to write gff_sequencing in, see table_store.py
+          rebuild: bool
+              ignore the cache and re-parse every file
+
+      @returns
+          gff_sequencing: pd.DataFrame
+              the merged table, indexed by Gene ID
+          gene_count: dict
+              .gff file name -> number of genes read from it
+    """
+    parent_path = parent_path if parent_path[-1] == "/" else parent_path + "/"
     gff_path = parent_path + "ppan_dataset/GFF/"
-    gff_file_list = os.listdir(gff_path)
-    os.chdir(gff_path)
+    gff_file_list = sorted(file for file in os.listdir(gff_path) if '.gff' in file)
+    workers = mp.cpu_count() if workers is None else workers
 
-    gene_count = {}
+    cache = GFFCache(parent_path + "trimmed_matrix_files/gff_cache/")
+    if rebuild:
+        cache.evict([])
+    cache.evict(gff_file_list)
+    stale_files = cache.stale(gff_path, gff_file_list)
 
-    out_df = pd.DataFrame(columns=['Gene ID', 'Gene Symbol', 'UniProtKB',
-                                   'Annotation', 'Organism'])
+    if stale_files:
+        with mp.Pool(processes=max(1, min(workers, len(stale_files)))) as p:
+            tables = p.map(parseGFFFile, [gff_path + file for file in stale_files])
+        for (file, fingerprint), table in zip(stale_files.items(), tables):
+            cache.update(file, fingerprint, table)
+    cache.save()
 
-    for file in gff_file_list:
-        count = 0
-        if '.gff' not in file:
-            continue
-        # create a sqlite3 db of the file in memory
-        curr_file = gffutils.create_db(file, dbfn=':memory:',
-                                       force=True, keep_order=True, merge_strategy='merge',
-                                       sort_attribute_values=True)
-        # sql stmt to select attributes of all rows
-        for row in curr_file.execute('SELECT attributes FROM features'):
-            # parse string attributes into dict
-            attribs = json.loads(row['attributes'])
-            res = updateDatabase(out_df, attribs, file.split('.')[0])
-            count+=1
-        gene_count.update({file:count})
-
-    print(gene_count)
-    out_df.set_index('Gene ID', inplace=True)
-    out_df.to_csv(parent_path + "trimmed_matrix_files/gff_sequencing.csv")
\ No newline at end of file
+    gene_count = {file: cache.index[file]['genes'] for file in gff_file_list}
+    gff_sequencing = cache.load(gff_file_list)
+    gff_sequencing.set_index('Gene ID', inplace=True)
+
+    write_table(gff_sequencing, parent_path + "trimmed_matrix_files/gff_sequencing", formats)
+    with open(parent_path + "gene_count.json", "w", encoding='utf-8') as file:
+        json.dump(gene_count, file)
+
+    return gff_sequencing, gene_count
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Build gff_sequencing out of the Prokka GFF files "
+                                                     "in <parent_dir>/ppan_dataset/GFF")
+    arg_parser.add_argument("parent_dir", help="the pangenome's parent directory")
+    arg_parser.add_argument("--workers", type=int, default=None,
+                            help="number of worker processes (default: number of CPU cores)")
+    arg_parser.add_argument("--rebuild", action="store_true",
+                            help="ignore the cache of parsed GFF files and re-parse all of them")
+    arg_parser.add_argument("--formats", nargs="+", choices=TABLE_FORMATS, default=list(DEFAULT_FORMATS),
+                            help="formats to write gff_sequencing in")
+    args = arg_parser.parse_args()
+
+    _, gene_count = buildGFFSequencing(args.parent_dir, args.workers, tuple(args.formats), args.rebuild)
+    print(gene_count)
\ No newline at end of file
@@ -0,0 +1,235 @@
+import gzip, hashlib, json, random, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+
+class FakeUniProtServer:
+    """
+        Local stand-in for the parts of rest.uniprot.org used by UniProtRESTHandler,
+        for tests and offline benchmarks. Implements
+
+            POST /idmapping/run
+            GET  /idmapping/status/<job id>
+            GET  /idmapping/details/<job id>
+            GET  /idmapping/uniprotkb/results/<job id>          (paginated, Link + x-total-results)
+            GET  /idmapping/uniprotkb/results/stream/<job id>
+
+        in json, tsv and xml, optionally gzip compressed. Every accession maps to
+        one synthetic UniProtKB entry with a protein name, an EC number and a few
+        GO cross references, all derived from a hash of the accession, except for a
+        fail_rate share of them which come back as failedIds.
+
+        Attributes:
+        -----------
+        latency: float
+            seconds added to every response
+        job_duration: float
+            seconds a job stays RUNNING after being submitted
+        page_size: int
+            maximum page size, whatever the client asks for. None to honour the
+            client's size
+        error_rate: float
+            share of requests answered with a 5xx error instead
+        retry_after: int
+            if set, injected errors are 503s carrying this Retry-After header
+        fail_rate: float
+            share of accessions that fail to map
+        stats: dict
+            'requests' per endpoint and 'errors' (injected 5xx count)
+    """
+    def __init__(self, latency: float = 0.0, job_duration: float = 0.0, page_size: int = None,
+                 error_rate: float = 0.0, retry_after: int = None, fail_rate: float = 0.0,
+                 seed: int = 0, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.job_duration = job_duration
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.stats = {'requests': {}, 'errors': 0}
+
+        self.httpd = ThreadingHTTPServer((host, port), self.requestHandler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    # --- synthetic data ---
+
+    @staticmethod
+    def digest(accession: str) -> int:
+        return int(hashlib.md5(accession.encode('utf-8')).hexdigest()[:8], 16)
+
+    def maps(self, accession: str) -> bool:
+        return (self.digest(accession) % 1000) / 1000 >= self.fail_rate
+
+    def entry(self, accession: str) -> dict:
+        h = self.digest(accession)
+        go_refs = [{"database": "GO", "id": f"GO:{(h >> (4 * x)) % 10000000:07d}",
+                    "properties": [{"key": "GoTerm", "value": f"{'PCF'[x % 3]}:synthetic term {(h >> x) % 997}"},
+                                   {"key": "GoEvidenceType", "value": "IEA:InterPro"}]}
+                   for x in range(1 + h % 4)]
+        return {"from": accession,
+                "to": {"primaryAccession": accession,
+                       "proteinDescription": {"recommendedName": {
+                           "fullName": {"value": f"Synthetic protein {accession}"},
+                           "ecNumbers": [{"value": f"{1 + h % 7}.{h % 20}.{h % 30}.{h % 200}"}]}},
+                       "uniProtKBCrossReferences": go_refs + [{"database": "Pfam", "id": f"PF{h % 99999:05d}",
+                                                               "properties": []}]}}
+
+    def xmlEntry(self, accession: str) -> str:
+        entry = self.entry(accession)['to']
+        refs = ''.join(f'<dbReference type="{x["database"]}" id="{x["id"]}"/>'
+                       for x in entry['uniProtKBCrossReferences'])
+        return (f'<entry dataset="Swiss-Prot"><accession>{accession}</accession>'
+                f'<protein><recommendedName><fullName>Synthetic protein {accession}</fullName>'
+                f'</recommendedName></protein>{refs}</entry>')
+
+    def page(self, job: dict, file_format: str, start: int, end: int) -> bytes:
+        mapped = job['mapped'][start:end]
+        if file_format == 'json':
+            body = {"results": [self.entry(x) for x in mapped]}
+            if start == 0 and job['failed']:
+                body["failedIds"] = job['failed']
+            return json.dumps(body).encode('utf-8')
+        if file_format == 'tsv':
+            return ("From\tEntry\n" + "".join(f"{x}\t{x}\n" for x in mapped)).encode('utf-8')
+        if file_format == 'xml':
+            return ('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
+                    '<uniprot xmlns="http://uniprot.org/uniprot" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+                    + "\n".join(self.xmlEntry(x) for x in mapped) +
+                    '\n<copyright>Synthetic data</copyright>\n</uniprot>').encode('utf-8')
+        raise ValueError(file_format)
+
+    # --- http ---
+
+    def requestHandler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def sendJSON(self, status: int, obj):
+                self.send(status, json.dumps(obj).encode('utf-8'), {'Content-Type': 'application/json'})
+
+            def prologue(self, endpoint: str) -> bool:
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    server.stats['requests'][endpoint] = server.stats['requests'].get(endpoint, 0) + 1
+                    inject = server.error_rate and server.random.random() < server.error_rate
+                    if inject:
+                        server.stats['errors'] += 1
+                if inject:
+                    if server.retry_after is not None:
+                        self.sendJSON(503, {"messages": ["injected"]})
+                    else:
+                        self.send(server.random.choice([500, 502, 503, 504]),
+                                  b'{"messages": ["injected"]}', {'Content-Type': 'application/json'})
+                    return False
+                return True
+
+            def send(self, status: int, body: bytes = b'', headers: dict = None):
+                headers = dict(headers or {})
+                if status == 503 and server.retry_after is not None:
+                    headers['Retry-After'] = server.retry_after
+                self.send_response(status)
+                for key, val in headers.items():
+                    self.send_header(key, str(val))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode('utf-8'))
+                if path != '/idmapping/run':
+                    return self.sendJSON(404, {"messages": ["not found"]})
+                if not self.prologue('run'):
+                    return
+                ids = [x for x in form.get('ids', [''])[0].split(',') if x]
+                job_id = uuid.uuid4().hex
+                with server.lock:
+                    server.jobs[job_id] = {'submitted': time.time(), 'from': form.get('from', [''])[0],
+                                           'to': form.get('to', [''])[0],
+                                           'mapped': [x for x in ids if server.maps(x)],
+                                           'failed': [x for x in ids if not server.maps(x)]}
+                self.sendJSON(200, {"jobId": job_id})
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                parts = parsed.path.strip('/').split('/')
+                query = parse_qs(parsed.query)
+                if len(parts) < 3 or parts[0] != 'idmapping':
+                    return self.sendJSON(404, {"messages": ["not found"]})
+                job = server.jobs.get(parts[-1])
+
+                if parts[1] == 'status':
+                    if not self.prologue('status'):
+                        return
+                    if job is None:
+                        return self.sendJSON(404, {"messages": ["job not found"]})
+                    if time.time() - job['submitted'] < server.job_duration:
+                        return self.sendJSON(200, {"jobStatus": "RUNNING"})
+                    return self.sendJSON(200, {"results": [server.entry(x) for x in job['mapped'][:1]],
+                                               "failedIds": job['failed']})
+
+                if parts[1] == 'details':
+                    if not self.prologue('details'):
+                        return
+                    if job is None:
+                        return self.sendJSON(404, {"messages": ["job not found"]})
+                    return self.sendJSON(200, {"redirectURL": f"{server.url}/idmapping/uniprotkb/results/{parts[-1]}",
+                                               "from": job['from'], "to": job['to']})
+
+                if 'results' in parts:
+                    stream = 'stream' in parts
+                    if not self.prologue('stream' if stream else 'results'):
+                        return
+                    if job is None:
+                        return self.sendJSON(404, {"messages": ["job not found"]})
+                    file_format = query.get('format', ['json'])[0]
+                    compressed = query.get('compressed', ['false'])[0].lower() == 'true'
+                    total = len(job['mapped'])
+                    headers = {'x-total-results': total}
+                    if stream:
+                        start, end = 0, total
+                    else:
+                        size = int(query.get('size', ['25'])[0])
+                        size = min(size, server.page_size) if server.page_size else size
+                        start = int(query.get('cursor', ['0'])[0])
+                        end = min(start + size, total)
+                        if end < total:
+                            query['cursor'] = [str(end)]
+                            next_url = f"{server.url}{parsed.path}?{urlencode(query, doseq=True)}"
+                            headers['Link'] = f'<{next_url}>; rel="next"'
+                    body = server.page(job, file_format, start, end)
+                    if compressed:
+                        body = gzip.compress(body)
+                    return self.send(200, body, headers)
+
+                self.sendJSON(404, {"messages": ["not found"]})
+
+        return Handler